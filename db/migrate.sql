@@ -0,0 +1,167 @@
+/*
+  Brings a database created by an older setup.sql up to date. setup.sql only runs when the pg-data volume
+  is first initialized, so existing databases get new schema from this script instead. Every statement is
+  idempotent: running it again, or on a database created by the current setup.sql, changes nothing.
+  NOTE: Keep in sync with the definitions in setup.sql
+*/
+
+-- Capacity limits for congestion detection, NULL for unlimited
+ALTER TABLE hub ADD COLUMN IF NOT EXISTS capacity INTEGER;
+ALTER TABLE path ADD COLUMN IF NOT EXISTS capacity INTEGER;
+
+-- Per-owner revision counters, bumped by the triggers below, and owner-scoped inconsistencies
+CREATE TABLE IF NOT EXISTS owner_revision(
+  owner_id INTEGER PRIMARY KEY, -- vehicles without an owner are counted under -1
+  revision BIGINT NOT NULL
+);
+
+
+CREATE OR REPLACE FUNCTION owner_movement_inconsistencies(owner INTEGER)
+RETURNS TABLE (
+  movement_id INTEGER,
+  vehicle_id INTEGER,
+  ts BIGINT,
+  inconsistency_type TEXT
+)
+LANGUAGE SQL
+STABLE
+AS $$
+  WITH owned AS (
+    SELECT MWA.movement_id, MWA.vehicle_id, MWA.ts, MWA.path_id, MWA.arrival_time
+    FROM movement_with_arrival MWA
+    JOIN vehicle V ON MWA.vehicle_id = V.vehicle_id
+    WHERE $1 IS NULL OR V.owner_id = $1
+  ), cte AS (
+    SELECT 
+      O.movement_id, 
+      O.vehicle_id,
+      O.ts, 
+      LAG(O.arrival_time) 
+        OVER(PARTITION BY O.vehicle_id ORDER BY O.arrival_time ASC) AS prev_arrival_ts,
+      P.start_hub_id,
+      LAG(P.end_hub_id) 
+        OVER(PARTITION BY O.vehicle_id ORDER BY O.arrival_time ASC) AS prev_arrival_hub
+    FROM owned O
+    JOIN path P ON O.path_id = P.path_id
+  )
+  SELECT movement_id, vehicle_id, ts, 'VEHICLE_NOT_IN_HUB'::TEXT AS inconsistency_type
+  FROM cte
+  WHERE prev_arrival_hub IS NOT NULL AND prev_arrival_ts IS NOT NULL
+    AND (start_hub_id != prev_arrival_hub OR ts < prev_arrival_ts)
+  UNION ALL
+  SELECT m1.movement_id, m1.vehicle_id, m1.ts, 'MULTIPLE_VEHICLE_DEPARTURES'::TEXT AS inconsistency_type
+  FROM movement m1
+  JOIN movement m2 ON m1.ts = m2.ts AND m1.vehicle_id = m2.vehicle_id AND m1.movement_id != m2.movement_id
+  JOIN vehicle V ON m1.vehicle_id = V.vehicle_id
+  WHERE $1 IS NULL OR V.owner_id = $1;
+$$;
+
+/* 
+  Lists inconsistencies in movement data of all vehicles. See owner_movement_inconsistencies.
+*/
+CREATE OR REPLACE VIEW movement_inconsistencies AS  
+SELECT movement_id, vehicle_id, ts, inconsistency_type
+FROM owner_movement_inconsistencies(NULL);
+
+CREATE OR REPLACE FUNCTION bump_owner_revisions(owners INTEGER[])
+RETURNS VOID
+LANGUAGE SQL
+AS $$
+  -- Rows are locked in owner_id order, so concurrent transactions touching several owners cannot deadlock
+  INSERT INTO owner_revision(owner_id, revision)
+  SELECT DISTINCT COALESCE(o, -1), 1 FROM unnest(owners) o
+  ORDER BY 1
+  ON CONFLICT (owner_id) DO UPDATE SET revision = owner_revision.revision + 1;
+$$;
+
+CREATE OR REPLACE FUNCTION movement_owner_revision()
+RETURNS TRIGGER
+LANGUAGE PLPGSQL
+AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    PERFORM bump_owner_revisions(ARRAY(SELECT V.owner_id FROM new_rows N JOIN vehicle V ON N.vehicle_id = V.vehicle_id));
+  ELSIF TG_OP = 'DELETE' THEN
+    PERFORM bump_owner_revisions(ARRAY(SELECT V.owner_id FROM old_rows O JOIN vehicle V ON O.vehicle_id = V.vehicle_id));
+  ELSE
+    PERFORM bump_owner_revisions(ARRAY(
+      SELECT V.owner_id FROM new_rows N JOIN vehicle V ON N.vehicle_id = V.vehicle_id
+      UNION
+      SELECT V.owner_id FROM old_rows O JOIN vehicle V ON O.vehicle_id = V.vehicle_id
+    ));
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION vehicle_owner_revision()
+RETURNS TRIGGER
+LANGUAGE PLPGSQL
+AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    PERFORM bump_owner_revisions(ARRAY(SELECT owner_id FROM new_rows));
+  ELSIF TG_OP = 'DELETE' THEN
+    PERFORM bump_owner_revisions(ARRAY(SELECT owner_id FROM old_rows));
+  ELSE
+    PERFORM bump_owner_revisions(ARRAY(SELECT owner_id FROM new_rows UNION SELECT owner_id FROM old_rows));
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION network_owner_revision()
+RETURNS TRIGGER
+LANGUAGE PLPGSQL
+AS $$
+BEGIN
+  PERFORM bump_owner_revisions(ARRAY(SELECT DISTINCT owner_id FROM vehicle));
+  RETURN NULL;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS movement_insert_revision_trigger ON movement;
+CREATE TRIGGER movement_insert_revision_trigger AFTER INSERT ON movement
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION movement_owner_revision();
+
+DROP TRIGGER IF EXISTS movement_update_revision_trigger ON movement;
+CREATE TRIGGER movement_update_revision_trigger AFTER UPDATE ON movement
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION movement_owner_revision();
+
+DROP TRIGGER IF EXISTS movement_delete_revision_trigger ON movement;
+CREATE TRIGGER movement_delete_revision_trigger AFTER DELETE ON movement
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION movement_owner_revision();
+
+DROP TRIGGER IF EXISTS vehicle_insert_revision_trigger ON vehicle;
+CREATE TRIGGER vehicle_insert_revision_trigger AFTER INSERT ON vehicle
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION vehicle_owner_revision();
+
+DROP TRIGGER IF EXISTS vehicle_update_revision_trigger ON vehicle;
+CREATE TRIGGER vehicle_update_revision_trigger AFTER UPDATE ON vehicle
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION vehicle_owner_revision();
+
+DROP TRIGGER IF EXISTS vehicle_delete_revision_trigger ON vehicle;
+CREATE TRIGGER vehicle_delete_revision_trigger AFTER DELETE ON vehicle
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION vehicle_owner_revision();
+
+DROP TRIGGER IF EXISTS model_revision_trigger ON model;
+CREATE TRIGGER model_revision_trigger AFTER INSERT OR UPDATE OR DELETE ON model
+FOR EACH STATEMENT EXECUTE FUNCTION network_owner_revision();
+
+DROP TRIGGER IF EXISTS hub_revision_trigger ON hub;
+CREATE TRIGGER hub_revision_trigger AFTER INSERT OR UPDATE OR DELETE ON hub
+FOR EACH STATEMENT EXECUTE FUNCTION network_owner_revision();
+
+DROP TRIGGER IF EXISTS path_revision_trigger ON path;
+CREATE TRIGGER path_revision_trigger AFTER INSERT OR UPDATE OR DELETE ON path
+FOR EACH STATEMENT EXECUTE FUNCTION network_owner_revision();
+
+CREATE INDEX IF NOT EXISTS vehicle_owner_idx ON vehicle(owner_id, vehicle_id) WHERE owner_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS movement_vehicle_ts_idx ON movement(vehicle_id, ts);
+CREATE INDEX IF NOT EXISTS movement_path_idx ON movement(path_id);
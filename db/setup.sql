@@ -41,18 +41,25 @@ CREATE TABLE IF NOT EXISTS hub(
   hub_id SERIAL PRIMARY KEY,
   label TEXT,
   posX FLOAT NOT NULL,
-  posY FLOAT NOT NULL
+  posY FLOAT NOT NULL,
+  capacity INTEGER -- max vehicles in the hub at once, NULL for unlimited
 );
 
 CREATE TABLE IF NOT EXISTS path(
   path_id SERIAL PRIMARY KEY,
   start_hub_id INTEGER NOT NULL,
   end_hub_id INTEGER NOT NULL,
+  capacity INTEGER, -- max vehicles on the path at once, NULL for unlimited
   -- distance FLOAT NOT NULL,
   CONSTRAINT fk_path_start_hub FOREIGN KEY(start_hub_id) REFERENCES hub(hub_id),
   CONSTRAINT fk_path_end_hub FOREIGN KEY(end_hub_id) REFERENCES hub(hub_id)
 );
 
+CREATE TABLE IF NOT EXISTS owner_revision(
+  owner_id INTEGER PRIMARY KEY, -- vehicles without an owner are counted under -1
+  revision BIGINT NOT NULL
+);
+
 CREATE TABLE IF NOT EXISTS movement(
   movement_id SERIAL PRIMARY KEY,
   ts BIGINT NOT NULL,
@@ -62,6 +69,23 @@ CREATE TABLE IF NOT EXISTS movement(
   CONSTRAINT fk_movement_path FOREIGN KEY(path_id) REFERENCES path(path_id)
 );
 
+-- Demand: cargo available at origin_hub_id from ready_ts, to be delivered to destination_hub_id by due_ts.
+-- vehicle_id, pickup_ts and delivery_ts are filled in when editor/dispatcher.py assigns the request.
+CREATE TABLE IF NOT EXISTS transport_request(
+  request_id SERIAL PRIMARY KEY,
+  origin_hub_id INTEGER NOT NULL,
+  destination_hub_id INTEGER NOT NULL,
+  ready_ts BIGINT NOT NULL DEFAULT 0,
+  due_ts BIGINT, -- NULL for no deadline
+  vehicle_id INTEGER,
+  pickup_ts BIGINT,
+  delivery_ts FLOAT,
+  CONSTRAINT fk_transport_request_origin FOREIGN KEY(origin_hub_id) REFERENCES hub(hub_id),
+  CONSTRAINT fk_transport_request_destination FOREIGN KEY(destination_hub_id) REFERENCES hub(hub_id),
+  CONSTRAINT fk_transport_request_vehicle FOREIGN KEY(vehicle_id) REFERENCES vehicle(vehicle_id),
+  CONSTRAINT transport_request_distinct_hubs CHECK (origin_hub_id <> destination_hub_id)
+);
+
 
 -- VIEWS
 /* 
@@ -87,32 +111,57 @@ FROM cte;
 
 
 /*
-  Lists inconsistencies in movement data:
+  Lists inconsistencies in movement data of the vehicles of one owner, or of all vehicles when owner is NULL:
    - Vehicles leaving from a hub it was not present in
    - Multiple departures of same vehicle at same timestamp
+  Movements are restricted to the owner before the window functions run, so the cost depends on that owner's fleet.
 */
-CREATE OR REPLACE VIEW movement_inconsistencies AS  
-WITH cte AS (
-	SELECT 
-		MWA.movement_id, 
-		MWA.vehicle_id,
-		MWA.ts, 
-		LAG(MWA.arrival_time) 
-			OVER(PARTITION BY MWA.vehicle_id ORDER BY MWA.arrival_time ASC) AS prev_arrival_ts,
-		P.start_hub_id,
-		LAG(P.end_hub_id) 
-			OVER(PARTITION BY MWA.vehicle_id ORDER BY MWA.arrival_time ASC) AS prev_arrival_hub
-	FROM movement_with_arrival MWA
-	JOIN path P ON MWA.path_id = P.path_id
+CREATE OR REPLACE FUNCTION owner_movement_inconsistencies(owner INTEGER)
+RETURNS TABLE (
+  movement_id INTEGER,
+  vehicle_id INTEGER,
+  ts BIGINT,
+  inconsistency_type TEXT
 )
-SELECT movement_id, vehicle_id, ts, 'VEHICLE_NOT_IN_HUB' AS inconsistency_type
-FROM cte
-WHERE prev_arrival_hub IS NOT NULL AND prev_arrival_ts IS NOT NULL
-	AND (start_hub_id != prev_arrival_hub OR ts < prev_arrival_ts)
-UNION ALL
-SELECT m1.movement_id, m1.vehicle_id, m1.ts, 'MULTIPLE_VEHICLE_DEPARTURES' AS inconsistency_type
-FROM movement m1
-JOIN movement m2 ON m1.ts = m2.ts AND m1.vehicle_id = m2.vehicle_id AND m1.movement_id != m2.movement_id;
+LANGUAGE SQL
+STABLE
+AS $$
+  WITH owned AS (
+    SELECT MWA.movement_id, MWA.vehicle_id, MWA.ts, MWA.path_id, MWA.arrival_time
+    FROM movement_with_arrival MWA
+    JOIN vehicle V ON MWA.vehicle_id = V.vehicle_id
+    WHERE $1 IS NULL OR V.owner_id = $1
+  ), cte AS (
+    SELECT 
+      O.movement_id, 
+      O.vehicle_id,
+      O.ts, 
+      LAG(O.arrival_time) 
+        OVER(PARTITION BY O.vehicle_id ORDER BY O.arrival_time ASC) AS prev_arrival_ts,
+      P.start_hub_id,
+      LAG(P.end_hub_id) 
+        OVER(PARTITION BY O.vehicle_id ORDER BY O.arrival_time ASC) AS prev_arrival_hub
+    FROM owned O
+    JOIN path P ON O.path_id = P.path_id
+  )
+  SELECT movement_id, vehicle_id, ts, 'VEHICLE_NOT_IN_HUB'::TEXT AS inconsistency_type
+  FROM cte
+  WHERE prev_arrival_hub IS NOT NULL AND prev_arrival_ts IS NOT NULL
+    AND (start_hub_id != prev_arrival_hub OR ts < prev_arrival_ts)
+  UNION ALL
+  SELECT m1.movement_id, m1.vehicle_id, m1.ts, 'MULTIPLE_VEHICLE_DEPARTURES'::TEXT AS inconsistency_type
+  FROM movement m1
+  JOIN movement m2 ON m1.ts = m2.ts AND m1.vehicle_id = m2.vehicle_id AND m1.movement_id != m2.movement_id
+  JOIN vehicle V ON m1.vehicle_id = V.vehicle_id
+  WHERE $1 IS NULL OR V.owner_id = $1;
+$$;
+
+/* 
+  Lists inconsistencies in movement data of all vehicles. See owner_movement_inconsistencies.
+*/
+CREATE OR REPLACE VIEW movement_inconsistencies AS  
+SELECT movement_id, vehicle_id, ts, inconsistency_type
+FROM owner_movement_inconsistencies(NULL);
 
 
 /*
@@ -212,6 +261,13 @@ $$;
 
 -- INDEXES
 CREATE INDEX IF NOT EXISTS movement_timestamp_idx ON movement(ts);
+-- Owner-scoped queries find the owner's vehicles, then each vehicle's movements in time order
+CREATE INDEX IF NOT EXISTS vehicle_owner_idx ON vehicle(owner_id, vehicle_id) WHERE owner_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS movement_vehicle_ts_idx ON movement(vehicle_id, ts);
+-- Per-owner conflict detection finds the vehicles sharing the owner's hubs through the paths they use
+CREATE INDEX IF NOT EXISTS movement_path_idx ON movement(path_id);
+-- The dispatcher only reads requests that are not assigned yet
+CREATE INDEX IF NOT EXISTS transport_request_unassigned_idx ON transport_request(ready_ts, request_id) WHERE vehicle_id IS NULL;
 
 
 -- PROCEDURES
@@ -389,6 +445,101 @@ BEFORE INSERT OR UPDATE ON vehicle
 FOR EACH ROW
 EXECUTE FUNCTION set_vehicle_label();
 
+/*
+  Revision counters let readers cache per-owner results and invalidate them only when that owner's data changes.
+  Changes to vehicles and movements bump the revision of the owners involved; changes to models, hubs and paths
+  can affect any owner's movements and bump every owner with vehicles.
+*/
+CREATE OR REPLACE FUNCTION bump_owner_revisions(owners INTEGER[])
+RETURNS VOID
+LANGUAGE SQL
+AS $$
+  -- Rows are locked in owner_id order, so concurrent transactions touching several owners cannot deadlock
+  INSERT INTO owner_revision(owner_id, revision)
+  SELECT DISTINCT COALESCE(o, -1), 1 FROM unnest(owners) o
+  ORDER BY 1
+  ON CONFLICT (owner_id) DO UPDATE SET revision = owner_revision.revision + 1;
+$$;
+
+CREATE OR REPLACE FUNCTION movement_owner_revision()
+RETURNS TRIGGER
+LANGUAGE PLPGSQL
+AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    PERFORM bump_owner_revisions(ARRAY(SELECT V.owner_id FROM new_rows N JOIN vehicle V ON N.vehicle_id = V.vehicle_id));
+  ELSIF TG_OP = 'DELETE' THEN
+    PERFORM bump_owner_revisions(ARRAY(SELECT V.owner_id FROM old_rows O JOIN vehicle V ON O.vehicle_id = V.vehicle_id));
+  ELSE
+    PERFORM bump_owner_revisions(ARRAY(
+      SELECT V.owner_id FROM new_rows N JOIN vehicle V ON N.vehicle_id = V.vehicle_id
+      UNION
+      SELECT V.owner_id FROM old_rows O JOIN vehicle V ON O.vehicle_id = V.vehicle_id
+    ));
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION vehicle_owner_revision()
+RETURNS TRIGGER
+LANGUAGE PLPGSQL
+AS $$
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    PERFORM bump_owner_revisions(ARRAY(SELECT owner_id FROM new_rows));
+  ELSIF TG_OP = 'DELETE' THEN
+    PERFORM bump_owner_revisions(ARRAY(SELECT owner_id FROM old_rows));
+  ELSE
+    PERFORM bump_owner_revisions(ARRAY(SELECT owner_id FROM new_rows UNION SELECT owner_id FROM old_rows));
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION network_owner_revision()
+RETURNS TRIGGER
+LANGUAGE PLPGSQL
+AS $$
+BEGIN
+  PERFORM bump_owner_revisions(ARRAY(SELECT DISTINCT owner_id FROM vehicle));
+  RETURN NULL;
+END;
+$$;
+
+CREATE TRIGGER movement_insert_revision_trigger AFTER INSERT ON movement
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION movement_owner_revision();
+
+CREATE TRIGGER movement_update_revision_trigger AFTER UPDATE ON movement
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION movement_owner_revision();
+
+CREATE TRIGGER movement_delete_revision_trigger AFTER DELETE ON movement
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION movement_owner_revision();
+
+CREATE TRIGGER vehicle_insert_revision_trigger AFTER INSERT ON vehicle
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION vehicle_owner_revision();
+
+CREATE TRIGGER vehicle_update_revision_trigger AFTER UPDATE ON vehicle
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION vehicle_owner_revision();
+
+CREATE TRIGGER vehicle_delete_revision_trigger AFTER DELETE ON vehicle
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION vehicle_owner_revision();
+
+CREATE TRIGGER model_revision_trigger AFTER INSERT OR UPDATE OR DELETE ON model
+FOR EACH STATEMENT EXECUTE FUNCTION network_owner_revision();
+
+CREATE TRIGGER hub_revision_trigger AFTER INSERT OR UPDATE OR DELETE ON hub
+FOR EACH STATEMENT EXECUTE FUNCTION network_owner_revision();
+
+CREATE TRIGGER path_revision_trigger AFTER INSERT OR UPDATE OR DELETE ON path
+FOR EACH STATEMENT EXECUTE FUNCTION network_owner_revision();
+
 -- -- DISABLED: DOES NOT ACCOUNT FOR CHANGES ON HUB POSITION
 -- CREATE OR REPLACE FUNCTION set_path_distance()
 -- RETURNS TRIGGER
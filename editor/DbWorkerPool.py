@@ -0,0 +1,109 @@
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+from psycopg2.extensions import connection as pg_connection
+from typing import Any, Callable, Optional, Set
+from db import connect_to_db, close_all_db_connections, logger
+
+
+class DbJobSignals(QObject):
+  finished = pyqtSignal(object)
+  failed = pyqtSignal(object)
+  cancelled = pyqtSignal()
+  done = pyqtSignal()
+
+
+class DbJob(QRunnable):
+  def __init__(self, fn: Callable[[], Any]) -> None:
+    QRunnable.__init__(self)
+    self.setAutoDelete(False)
+    self.fn = fn
+    self.signals = DbJobSignals()
+    self.is_cancelled = False
+    self._connection: Optional[pg_connection] = None
+
+  def run(self) -> None:
+    try:
+      if self.is_cancelled:
+        self.signals.cancelled.emit()
+        return
+      try:
+        self._connection = connect_to_db()
+        result = self.fn()
+      except Exception as e:
+        if self._connection is not None and not self._connection.closed:
+          self._connection.rollback()
+        if self.is_cancelled:
+          logger.debug('Query cancelled: %s', e)
+          self.signals.cancelled.emit()
+        else:
+          self.signals.failed.emit(e)
+        return
+      finally:
+        connection, self._connection = self._connection, None
+      # End the transaction opened by reads (writes have committed already), so the idle worker
+      # connection holds no locks that would block DDL from other clients
+      try:
+        connection.rollback()
+      except Exception as e:
+        logger.warning('Could not end transaction after job: %s', e)
+      # The function completed, so whatever it did (e.g. committing a save) has taken effect and
+      # its result is delivered even if a cancel arrived too late to interrupt it
+      self.signals.finished.emit(result)
+    finally:
+      self.signals.done.emit()
+
+  def cancel(self) -> None:
+    self.is_cancelled = True
+    connection = self._connection
+    if connection is not None:
+      # Asks the backend to abort whatever statement the worker is currently blocked on
+      connection.cancel()
+
+
+class DbWorkerPool(QObject):
+  busy_changed = pyqtSignal(bool)
+
+  def __init__(self, max_workers: int = 4, parent=None) -> None:
+    QObject.__init__(self, parent)
+    self._pool = QThreadPool(self)
+    self._pool.setMaxThreadCount(max_workers)
+    # Keep worker threads, and with them their connections, alive for the lifetime of the pool
+    self._pool.setExpiryTimeout(-1)
+    self._jobs: Set[DbJob] = set()
+
+  def submit(
+    self,
+    fn: Callable[[], Any],
+    on_result: Callable[[Any], None],
+    on_error: Optional[Callable[[Exception], None]] = None,
+    on_cancelled: Optional[Callable[[], None]] = None,
+  ) -> DbJob:
+    job = DbJob(fn)
+    job.signals.finished.connect(on_result)
+    if on_error is not None:
+      job.signals.failed.connect(on_error)
+    if on_cancelled is not None:
+      job.signals.cancelled.connect(on_cancelled)
+    job.signals.done.connect(lambda: self._job_done(job))
+
+    self._jobs.add(job)
+    if len(self._jobs) == 1:
+      self.busy_changed.emit(True)
+    self._pool.start(job)
+    return job
+
+  def _job_done(self, job: DbJob) -> None:
+    self._jobs.discard(job)
+    if len(self._jobs) == 0:
+      self.busy_changed.emit(False)
+
+  def is_busy(self) -> bool:
+    return len(self._jobs) > 0
+
+  def cancel_all(self) -> None:
+    for job in list(self._jobs):
+      job.cancel()
+
+  def shutdown(self) -> None:
+    self.cancel_all()
+    self._pool.waitForDone()
+    close_all_db_connections()
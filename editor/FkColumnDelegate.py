@@ -1,8 +1,10 @@
-from PyQt5.QtCore import Qt, QModelIndex, QAbstractItemModel
+from PyQt5 import sip
+from PyQt5.QtCore import Qt, QModelIndex, QAbstractItemModel, QObject
 from PyQt5.QtWidgets import QStyledItemDelegate, QWidget, QStyleOptionViewItem, QComboBox
-from FkTableModel import FkTableModelColumn, DisplaySchemaColumn, DeleteButtonColumn
-from db import query
-from typing import List, Union
+from FkTableModel import FkTableModelColumn, DisplaySchemaColumn, DeleteButtonColumn, ForeignKeySpecification, FkLabelIndex
+from DbWorkerPool import DbWorkerPool
+from db import query, logger
+from typing import Callable, Dict, List, Optional, Tuple, Union
 from PyQt5.QtWidgets import QPushButton
 from PyQt5.QtCore import Qt
 
@@ -37,34 +39,131 @@ class DeleteButtonDelegate(QStyledItemDelegate):
     self.commitData.emit(self.sender())
 
 
+FkOptions = List[List[Union[str, int, float]]]
+
+
+class FkOptionsCache(QObject):
+  def __init__(self, pool: DbWorkerPool, parent=None) -> None:
+    QObject.__init__(self, parent)
+    self._pool = pool
+    self._options: Dict[str, FkOptions] = {}
+    # Per query, the (callback, onError) pairs of every caller waiting for the fetch
+    self._waiting: Dict[str, List[Tuple[Callable[[FkOptions], None], Optional[Callable[[Union[Exception, str]], None]]]]] = {}
+    self._indexes: Dict[Tuple[str, str], FkLabelIndex] = {}
+    # Bumped on invalidate so that fetches started before it are not cached
+    self._generation = 0
+
+  def _options_query(self, fk_options: ForeignKeySpecification) -> str:
+    to_query = [fk_options.foreign_column_name] + fk_options.display_columns + [x.column_name for x in fk_options.auxiliary_columns]
+    return f"""SELECT {", ".join(to_query)} FROM {fk_options.reference_table}{"".join([" " + j for j in fk_options.additional_joins])} ORDER BY {fk_options.foreign_column_name};"""
+
+  def get(self, fk_options: ForeignKeySpecification, callback: Callable[[FkOptions], None], onError: Optional[Callable[[Union[Exception, str]], None]] = None) -> None:
+    # onError is called instead of callback if the fetch fails or is cancelled
+    key = self._options_query(fk_options)
+    if key in self._options:
+      callback(self._options[key])
+      return
+    if key in self._waiting:
+      self._waiting[key].append((callback, onError))
+      return
+    self._waiting[key] = [(callback, onError)]
+
+    generation = self._generation
+
+    def fetch_options() -> FkOptions:
+      with query(key) as results:
+        return [list(row) for row in results]
+
+    def on_options(options: FkOptions) -> None:
+      if generation == self._generation:
+        self._options[key] = options
+      for waiting, _ in self._waiting.pop(key, []):
+        waiting(options)
+
+    def on_failed(e: Union[Exception, str]) -> None:
+      logger.error(e)
+      for _, waiting_error in self._waiting.pop(key, []):
+        if waiting_error is not None:
+          waiting_error(e)
+
+    self._pool.submit(fetch_options, on_options, on_failed, lambda: on_failed("Query cancelled"))
+
+  def get_index(self, fk_options: ForeignKeySpecification, callback: Callable[[FkLabelIndex], None], onError: Optional[Callable[[Union[Exception, str]], None]] = None) -> None:
+    # The label index is built once per cached options list
+    key = self._options_query(fk_options)
+
+    def on_options(options: FkOptions) -> None:
+      index = self._indexes.get((key, fk_options.display_format))
+      if index is None or index.options is not options:
+        index = FkLabelIndex(fk_options, options)
+        if self._options.get(key) is options:
+          self._indexes[(key, fk_options.display_format)] = index
+      callback(index)
+
+    self.get(fk_options, on_options, onError)
+
+  def prefetch(self, fk_options: ForeignKeySpecification) -> None:
+    self.get(fk_options, lambda _: None)
+
+  def invalidate(self, fk_options: Optional[ForeignKeySpecification] = None) -> None:
+    # Drops the cached options of fk_options, or of every FK when None
+    self._generation += 1
+    if fk_options is None:
+      self._options.clear()
+      self._indexes.clear()
+      return
+    key = self._options_query(fk_options)
+    self._options.pop(key, None)
+    self._indexes = {k: index for k, index in self._indexes.items() if k[0] != key}
+
+
 class FkColumnDelegateComboBox(QComboBox):
-  def __init__(self, options: List[List[Union[str, int, float]]], schema: DisplaySchemaColumn, parent=None, *args) -> None:
+  def __init__(self, schema: DisplaySchemaColumn, parent=None, *args) -> None:
     QComboBox.__init__(self, parent, *args)
+    self.schema = schema
+    self.options = []
+    self._pending_id_value = None
+    self.setInsertPolicy(QComboBox.NoInsert)
+    self.addItem("Loading...")
+    self.setEnabled(False)
+
+  def setOptions(self, options: FkOptions) -> None:
     self.options = options
-    display_options = [schema.fk_options.display_format.format(*row[1 : len(schema.fk_options.display_columns) + 1]) for row in self.options]
+    display_options = [self.schema.fk_options.display_text(row) for row in self.options]
+    self.clear()
     self.insertItems(0, display_options)
-    self.setInsertPolicy(QComboBox.NoInsert)
+    self.setEnabled(True)
+    if self._pending_id_value is not None:
+      self.setIndex(self._pending_id_value)
 
   def setIndex(self, id_value: int) -> None:
+    self._pending_id_value = id_value
     matches = [i for i in range(len(self.options)) if self.options[i][0] == id_value]
     if len(matches) == 1:
       self.setCurrentIndex(matches[0])
 
-  def currentOption(self) -> List[Union[str, int, float]]:
+  def currentOption(self) -> Optional[List[Union[str, int, float]]]:
+    if len(self.options) == 0:
+      return None
     return self.options[self.currentIndex()]
 
 class FkColumnDelegate(DeleteButtonDelegate):
-  def __init__(self, parent=None, *args):
+  def __init__(self, options_cache: FkOptionsCache, parent=None, *args):
     DeleteButtonDelegate.__init__(self, parent, *args)
+    self._options_cache = options_cache
 
   def createEditor(self, parent: QWidget, option: QStyleOptionViewItem, index: QModelIndex) -> QWidget:
     data = index.data(Qt.EditRole)
     if isinstance(data, FkTableModelColumn):
-      to_query = [data.schema.fk_options.foreign_column_name] + data.schema.fk_options.display_columns + [x.column_name for x in data.schema.fk_options.auxiliary_columns]
-      with query(f"""SELECT {", ".join(to_query)} FROM {data.schema.fk_options.reference_table}{"".join([" " + j for j in data.schema.fk_options.additional_joins])} ORDER BY {data.schema.fk_options.foreign_column_name};""") as results:
-        options = [list(row) for row in results]
-        editor = FkColumnDelegateComboBox(options, data.schema, parent)
-        return editor
+      editor = FkColumnDelegateComboBox(data.schema, parent)
+
+      def on_options(options: FkOptions) -> None:
+        # The editor may have been closed before the options arrived
+        if not sip.isdeleted(editor):
+          editor.setOptions(options)
+
+      self._options_cache.get(data.schema.fk_options, on_options)
+      return editor
     else:
       return super(FkColumnDelegate, self).createEditor(parent, option, index)
 
@@ -78,7 +177,9 @@ class FkColumnDelegate(DeleteButtonDelegate):
   def setModelData(self, editor: QWidget, model: QAbstractItemModel, index: QModelIndex) -> None:
     data = index.data(Qt.EditRole)
     if isinstance(data, FkTableModelColumn):
-      model.setData(index, editor.currentOption(), Qt.EditRole)
+      option = editor.currentOption()
+      if option is not None:
+        model.setData(index, option, Qt.EditRole)
     else:
       super(FkColumnDelegate, self).setModelData(editor, model, index)
 
@@ -7,10 +7,14 @@ from PyQt5.QtCore import (
   pyqtSignal,
 )
 from PyQt5.QtGui import QBrush, QColor
-from typing import List, Optional, Union, Tuple, Callable
-from collections import namedtuple
-from copy import deepcopy
-from db import query, connect_to_db
+from typing import List, Optional, Union, Tuple, Callable, Dict, Set
+from collections import namedtuple, defaultdict
+from array import array
+from bisect import bisect_left
+import math
+import sys
+from db import query, query_values, stream_query, connect_to_db
+from DbWorkerPool import DbWorkerPool
 from enum import IntEnum
 
 AuxiliaryColumn = namedtuple("AuxiliaryColumn", ["column_name", "header"])
@@ -40,12 +44,43 @@ class ForeignKeySpecification:
     self.auxiliary_columns = auxiliary_columns
     self.additional_joins = additional_joins
 
+  def display_text(self, values: List[Union[str, int, float]]) -> str:
+    # values: [id, *display_columns, *auxiliary_columns], as stored in FK cells and option rows
+    return self.display_format.format(*values[1 : len(self.display_columns) + 1])
+
+
+class FkLabelIndex:
+  # Reverse index from the display text of each option of a foreign key (and from its id) to the
+  # option rows, so imported labels resolve with one hash lookup each
+  def __init__(self, fk_options: ForeignKeySpecification, options: List[List[Union[str, int, float]]]) -> None:
+    self.fk_options = fk_options
+    self.options = options
+    self._by_label: Dict[str, List[List[Union[str, int, float]]]] = defaultdict(list)
+    self._by_id: Dict[str, List[Union[str, int, float]]] = {}
+    for option in options:
+      self._by_label[fk_options.display_text(option)].append(option)
+      self._by_id[str(option[0])] = option
+
+  def resolve(self, text: str) -> List[List[Union[str, int, float]]]:
+    # Every option the text may refer to: none if unresolved, several if ambiguous, including a
+    # label that reads as the id of another option (e.g. a hub labelled "3" and hub 3)
+    text = text.strip()
+    options = self._by_label.get(text, [])
+    by_id = self._by_id.get(text)
+    if by_id is not None and all(option is not by_id for option in options):
+      options = options + [by_id]
+    return options
+
 
 class DeleteButtonColumn:
   def __init__(self):
     pass
 
 
+# Edit value of every delete button cell
+DELETE_BUTTON = DeleteButtonColumn()
+
+
 class FkTableModelColumn:
   def __init__(self, id_value: int, schema: ForeignKeySpecification):
     self.id_value = id_value
@@ -53,12 +88,16 @@ class FkTableModelColumn:
 
 
 class DisplaySchemaColumn:
-  def __init__(self, column_name: str, header: str, default_value: Union[str, int, float], fk_options: Optional[ForeignKeySpecification] = None, isDeleteBtn: bool = False) -> None:
+  # A default_value of None makes the column nullable (an empty cell is NULL); value_type is then
+  # int unless given. Columns that are not editable are shown but never edited or imported.
+  def __init__(self, column_name: str, header: str, default_value: Union[str, int, float, None], fk_options: Optional[ForeignKeySpecification] = None, isDeleteBtn: bool = False, editable: bool = True, value_type: Optional[type] = None) -> None:
     self.column_name = column_name
     self.header = header
     self.fk_options = fk_options
     self.default_value = default_value
     self.isDeleteBtn = isDeleteBtn
+    self.editable = editable
+    self.value_type = value_type if value_type is not None else int if default_value is None else type(default_value)
 
   def is_fk(self) -> bool:
     return self.fk_options is not None
@@ -68,15 +107,87 @@ def strip_table_name(raw: str) -> str:
   return raw.split(".")[-1]
 
 
+
+
+Value = Union[str, int, float, None]
+# Formatted display text and auxiliary column values of one referenced row
+FkLabel = Tuple[str, Tuple[Value, ...]]
+
+INT = 'q'
+FLOAT = 'd'
+STR = 'str'
+_INT_NULL = -2 ** 63
+
+
+class ColumnStore:
+  # Rows of one table stored column by column: ids, FK ids and integers in array('q'), floats in
+  # array('d') and strings in a list. NULL is stored as INT64_MIN, NaN or None respectively.
+  def __init__(self, kinds: List[str]) -> None:
+    self.kinds = kinds
+    self.columns = [[] if kind == STR else array(kind) for kind in kinds]
+
+  def __len__(self) -> int:
+    return len(self.columns[0])
+
+  @staticmethod
+  def encode(kind: str, value: Value) -> Value:
+    if kind == INT:
+      return _INT_NULL if value is None else int(value)
+    if kind == FLOAT:
+      return math.nan if value is None else float(value)
+    return value
+
+  def get(self, r: int, c: int) -> Value:
+    value = self.columns[c][r]
+    kind = self.kinds[c]
+    if (kind == INT and value == _INT_NULL) or (kind == FLOAT and value != value):
+      return None
+    return value
+
+  def set(self, r: int, c: int, value: Value) -> None:
+    self.columns[c][r] = self.encode(self.kinds[c], value)
+
+  def row(self, r: int) -> List[Value]:
+    return [self.get(r, c) for c in range(len(self.columns))]
+
+  def append(self, values: List[Value]) -> None:
+    # Encode every value first so a bad one leaves the columns aligned
+    encoded = [self.encode(kind, value) for kind, value in zip(self.kinds, values)]
+    for column, value in zip(self.columns, encoded):
+      column.append(value)
+
+  def delete(self, first: int, last: int) -> None:
+    for column in self.columns:
+      del column[first : last + 1]
+
+
+# Built once; data() runs for every visible cell on each repaint
+_NO_DATA = QVariant()
+_DELETE_TEXT = QVariant("Delete")
+_DELETE_BUTTON = QVariant(DELETE_BUTTON)
+_DELETED_UNEDITABLE = QVariant(QBrush(QColor(0xbc, 0x54, 0x4b)))
+_DELETED = QVariant(QBrush(QColor(0xff, 0x00, 0x00)))
+_CREATED_UNEDITABLE = QVariant(QBrush(QColor(0x3d, 0xed, 0x97)))
+_CREATED = QVariant(QBrush(QColor(0x99, 0xed, 0xc3)))
+_UPDATED_UNEDITABLE = QVariant(QBrush(QColor(0x99, 0xbf, 0x00)))
+_UPDATED = QVariant(QBrush(QColor(0xdf, 0xff, 0x00)))
+_UNEDITABLE = QVariant(QBrush(QColor(0xe6, 0xe6, 0xe6)))
+
+
 class FkTableModel(QAbstractTableModel):
   data_changed = pyqtSignal(QModelIndex, QModelIndex, Qt.ItemDataRole)
+  saved = pyqtSignal()
 
-  def __init__(self, table_name: str, schema: List[DisplaySchemaColumn], onError: Callable[[str], None], clearError: Callable[[], None], parent=None, *args):
+  def __init__(self, table_name: str, schema: List[DisplaySchemaColumn], onError: Callable[[str], None], clearError: Callable[[], None], pool: DbWorkerPool, parent=None, *args):
     QAbstractTableModel.__init__(self, parent, *args)
     self.table_name = table_name
-    self._schema = schema + [DisplaySchemaColumn("Delete", "Delete", DeleteButtonColumn(), None, True)]
+    self._schema = schema + [DisplaySchemaColumn("Delete", "Delete", DELETE_BUTTON, None, True)]
     self.onError = onError
     self.clearError = clearError
+    self._pool = pool
+    # Set while a load or save runs on the worker pool; the table is read-only in the meantime
+    self._busy = False
+    self._loaded = False
     self._query_rows = []
     self._joins = []
     self._query_rows_to_schema = []
@@ -103,41 +214,110 @@ class FkTableModel(QAbstractTableModel):
 
     for i, col in enumerate(self._schema):
       self._displayed_columns_to_schema.append((i, None))
+      if not col.editable:
+        self._uneditable_columns.add(len(self._displayed_columns_to_schema) - 1)
       if col.is_fk() and len(col.fk_options.auxiliary_columns) > 0:
         for a in range(len(col.fk_options.auxiliary_columns)):
           self._displayed_columns_to_schema.append((i, a))
           self._uneditable_columns.add(len(self._displayed_columns_to_schema) - 1)
 
-    self._local_data = []
-
-    self._make_query()
+    # Columns of the table itself, returned by INSERT/UPDATE so trigger-set values are picked up.
+    # The delete column comes last, so these are also the ColumnStore column indexes.
+    self._base_schema_indexes = [i for i, col in enumerate(self._schema) if not col.isDeleteBtn]
+    self._returning = ", ".join([strip_table_name(self._schema[i].column_name) for i in self._base_schema_indexes])
+    self._fk_schema_indexes = [i for i, col in enumerate(self._schema) if col.is_fk()]
+    self._column_kinds = [self._column_kind(self._schema[i]) for i in self._base_schema_indexes]
+    # Position of each table column in a selected row; FK display and auxiliary columns follow it
+    self._query_offsets = [self._query_rows_to_schema.index(i) for i in self._base_schema_indexes]
+    # Shown for FK ids without a known label, e.g. the default of a new row
+    self._fk_blank_labels: Dict[int, FkLabel] = {}
+    for i in self._fk_schema_indexes:
+      fk_options = self._schema[i].fk_options
+      self._fk_blank_labels[i] = (fk_options.display_text([None] + ["" for _ in fk_options.display_columns]), tuple([None for _ in fk_options.auxiliary_columns]))
+
+    self._store = ColumnStore(self._column_kinds)
+    # {schema index: {FK id: label}}, shared by every row referencing the same id
+    self._fk_labels: Dict[int, Dict[int, FkLabel]] = {i: {} for i in self._fk_schema_indexes}
     self._resetChanged()
 
-  def _make_query(self):
-    self.beginResetModel()
-    self._local_data = []
-    with query(f"""SELECT {", ".join(self._query_rows)} FROM {self.table_name}{"".join([" " + j for j in self._joins])};""") as results:
+  @staticmethod
+  def _column_kind(column: DisplaySchemaColumn) -> str:
+    if column.is_fk() or column.value_type == int:
+      return INT
+    if column.value_type == float:
+      return FLOAT
+    return STR
+
+  def _select_statement(self, where: str = "") -> str:
+    return f"""SELECT {", ".join(self._query_rows)} FROM {self.table_name}{"".join([" " + j for j in self._joins])}{where};"""
+
+  def _fk_label(self, i: int, values: Tuple) -> FkLabel:
+    # values: [id, *display_columns, *auxiliary_columns]
+    fk_options = self._schema[i].fk_options
+    auxiliary = values[1 + len(fk_options.display_columns):]
+    return sys.intern(fk_options.display_text(values)), tuple([sys.intern(v) if isinstance(v, str) else v for v in auxiliary])
+
+  def _add_fk_labels(self, labels: Dict[int, Dict[int, FkLabel]], row: Tuple, replace: bool) -> None:
+    # Formats each FK of a selected row, unless its id already has a label
+    for i in self._fk_schema_indexes:
+      offset = self._query_offsets[i]
+      id_value = row[offset]
+      if id_value is None:
+        continue
+      if replace or id_value not in labels[i]:
+        fk_options = self._schema[i].fk_options
+        labels[i][id_value] = self._fk_label(i, row[offset : offset + 1 + len(fk_options.display_columns) + len(fk_options.auxiliary_columns)])
+
+  def _fk_label_for(self, r: int, i: int) -> FkLabel:
+    label = self._fk_labels[i].get(self._store.get(r, i))
+    return label if label is not None else self._fk_blank_labels[i]
+
+  def _fetch_rows(self) -> Tuple[ColumnStore, Dict[int, Dict[int, FkLabel]]]:
+    # Runs on a worker thread; rows are streamed straight into the columns
+    store = ColumnStore(self._column_kinds)
+    labels = {i: {} for i in self._fk_schema_indexes}
+    columns = list(zip(store.columns, self._column_kinds, self._query_offsets))
+    with stream_query(self._select_statement()) as results:
       for row in results:
-        row_result = []
-
-        curr_schema_col = 0
-        col_results = []
-        for i, column in enumerate(row):
-          schema_column_index = self._query_rows_to_schema[i]
-          if curr_schema_col == schema_column_index:
-            col_results.append(column)
-          else:
-            row_result.append(col_results)
-            curr_schema_col += 1
-            col_results = [column]
-        row_result.append(col_results)
-        row_result.append([DeleteButtonColumn()])
-        self._local_data.append(row_result)
+        for column, kind, offset in columns:
+          column.append(ColumnStore.encode(kind, row[offset]))
+        self._add_fk_labels(labels, row, False)
+    return store, labels
+
+  def _on_rows_loaded(self, result: Tuple[ColumnStore, Dict[int, Dict[int, FkLabel]]]) -> None:
+    self.beginResetModel()
+    self._store, self._fk_labels = result
+    self._resetChanged()
     self.endResetModel()
+    self._busy = False
+    self._loaded = True
+
+  def _on_job_error(self, e: Exception) -> None:
+    self._busy = False
+    self.onError(e)
+
+  def _on_job_cancelled(self) -> None:
+    self._busy = False
+    self.onError("Query cancelled")
+
+  def load(self) -> None:
+    if self._busy:
+      return
+    self._busy = True
+    self._pool.submit(self._fetch_rows, self._on_rows_loaded, self._on_job_error, self._on_job_cancelled)
+
+  def ensure_loaded(self) -> None:
+    if not self._loaded:
+      self.load()
+
+  def foreign_keys(self) -> List[ForeignKeySpecification]:
+    # FKs the user picks or imports; read-only ones need no options
+    return [self._schema[i].fk_options for i in self._fk_schema_indexes if self._schema[i].editable]
 
   def _resetChanged(self):
-    self._changed = [[ChangedState.NONE for _ in row] for row in self._local_data]
-    self._changed_row = [ChangedState.NONE for _ in self._local_data]
+    # Only touched rows are tracked: {row: ChangedState} and {row: schema indexes of updated cells}
+    self._changed_rows: Dict[int, ChangedState] = {}
+    self._changed_cells: Dict[int, Set[int]] = {}
 
   def headerData(self, section: int, orientation: Qt.Orientation, role: int = Qt.DisplayRole) -> QVariant:
     if orientation == Qt.Horizontal and role == Qt.DisplayRole:
@@ -150,179 +330,301 @@ class FkTableModel(QAbstractTableModel):
     return super().headerData(section, orientation, role)
 
   def update(self, r: int, c: int, value: Union[str, int, float]):
-    old = None
-    if r < len(self._local_data) and c < len(self._local_data[0]):
-      old = deepcopy(self._local_data[r][c])
-    
     schema_column_index, _ = self._displayed_columns_to_schema[c]
-    isFk = self._schema[schema_column_index].is_fk()
-    if self._schema[schema_column_index].isDeleteBtn:
-      self._changed_row[r] ^= ChangedState.DELETED
-    elif isFk:
-      self._local_data[r][schema_column_index] = value
-    else: 
-      self._local_data[r][schema_column_index][0] = value
-    
-    if (old is None or old != value) and not self._schema[schema_column_index].isDeleteBtn:
-      self._changed[r][c] |= ChangedState.UPDATED 
-      self._changed_row[r] |= ChangedState.UPDATED 
+    schema_column = self._schema[schema_column_index]
+    if schema_column.isDeleteBtn:
+      state = self._changed_rows.get(r, ChangedState.NONE) ^ ChangedState.DELETED
+      if state == ChangedState.NONE:
+        del self._changed_rows[r]
+      else:
+        self._changed_rows[r] = state
+      self.clearError()
+      return
+
+    if schema_column.is_fk():
+      self._fk_labels[schema_column_index][value[0]] = self._fk_label(schema_column_index, value)
+      value = value[0]
+    try:
+      if schema_column.default_value is None and isinstance(value, str):
+        # Nullable columns are edited as text
+        value = self._parse_value(schema_column, value)
+      changed = self._store.get(r, schema_column_index) != value
+      self._store.set(r, schema_column_index, value)
+    except (TypeError, ValueError) as e:
+      self.onError(e)
+      return
+
+    if changed:
+      self._changed_cells.setdefault(r, set()).add(schema_column_index)
+      self._changed_rows[r] = self._changed_rows.get(r, ChangedState.NONE) | ChangedState.UPDATED
     self.clearError()
 
   def setData(self, index: QModelIndex, value: Union[str, int, float], role: Qt.ItemDataRole):
-    if role == Qt.EditRole:
+    if role == Qt.EditRole and not self._busy:
       self.update(index.row(), index.column(), value)
       self.data_changed.emit(index, index, role)
       return True
 
   def rowCount(self, parent) -> int:
-    return len(self._local_data)
+    return len(self._store)
 
   def columnCount(self, parent) -> int:
     return len(self._displayed_columns_to_schema)
 
   def reset(self) -> None:
-    self.beginResetModel()
-    self._make_query()
-    self._resetChanged()
-    self.endResetModel()
     self.clearError()
+    self.load()
 
-  def _delete_statement_for_row(self, row: List[List[Union[str, float, int]]]) -> Tuple[str, List[List[Union[str, float, int]]]]:
+  def _delete_statement_for_rows(self, id_values: List[int]) -> Tuple[str, List[List[int]]]:
     id_name = self._schema[0].column_name
-    id_value = row[0][0]
-    return f"""DELETE FROM {self.table_name} WHERE {id_name} = %s;""", [id_value]
+    return f"""DELETE FROM {self.table_name} WHERE {id_name} = ANY(%s);""", [id_values]
 
-  def _insert_statement_for_row(self, row: List[List[Union[str, float, int]]]) -> Tuple[str, List[List[Union[str, float, int]]]]:
-    col_names = []
-    col_values = []
-    for i, c in enumerate(row):
-      if i == 0 or self._schema[i].isDeleteBtn:
-        continue # id row not set
-      col_names.append(strip_table_name(self._schema[i].column_name))
-      col_values.append(c[0])
-    return f"""INSERT INTO {self.table_name} ({", ".join(col_names)}) VALUES({', '.join(['%s' for _ in col_names])});""", col_values
+  def _insert_statement_for_rows(self, rows: List[int]) -> Tuple[str, List[List[Value]]]:
+    # One multi-row INSERT; Postgres returns the RETURNING rows in VALUES order
+    columns = self._base_schema_indexes[1:] # id row not set
+    col_names = [strip_table_name(self._schema[i].column_name) for i in columns]
+    col_values = [[self._store.get(r, i) for i in columns] for r in rows]
+    return f"""INSERT INTO {self.table_name} ({", ".join(col_names)}) VALUES %s RETURNING {self._returning};""", col_values
 
-  def _update_statement_for_row(self, row: List[List[Union[str, float, int]]], changed_row: List[int]) -> Tuple[str, List[List[Union[str, float, int]]]]:
+  def _update_statement_for_row(self, r: int, changed_columns: Set[int]) -> Tuple[str, List[Value]]:
     col_names = []
     col_values = []
     id_name = self._schema[0].column_name
-    id_value = row[0][0]
-    for i, c in enumerate(row):
-      if changed_row[i] & ChangedState.UPDATED:
-        col_names.append(strip_table_name(self._schema[i].column_name))
-        col_values.append(c[0])
-    return f"""UPDATE {self.table_name} SET {", ".join([cn + ' = %s' for cn in col_names])} WHERE {id_name} = %s;""", col_values + [id_value]
-
-  def _flush_changes(self) -> None:
-    statements = []
-    for i, row in enumerate(self._local_data):
-      if self._changed_row[i] & ChangedState.CREATED and self._changed_row[i] & ChangedState.DELETED:
+    id_value = self._store.get(r, 0)
+    for i in sorted(changed_columns):
+      col_names.append(strip_table_name(self._schema[i].column_name))
+      col_values.append(self._store.get(r, i))
+    return f"""UPDATE {self.table_name} SET {", ".join([cn + ' = %s' for cn in col_names])} WHERE {id_name} = %s RETURNING {self._returning};""", col_values + [id_value]
+
+  def _flush_changes(self) -> Dict[int, Optional[Tuple]]:
+    # Returns the RETURNING values of each inserted or updated row, keyed by row index
+    returned = {}
+    deleted = []
+    created = []
+    try:
+      for r in sorted(self._changed_rows):
+        state = self._changed_rows[r]
+        if state & ChangedState.CREATED and state & ChangedState.DELETED:
+          continue
+        if state & ChangedState.DELETED:
+          deleted.append(self._store.get(r, 0))
+        elif state & ChangedState.CREATED:
+          created.append(r)
+        elif state & ChangedState.UPDATED:
+          with query(*self._update_statement_for_row(r, self._changed_cells[r])) as results:
+            returned[r] = results.fetchone()
+      if len(deleted) > 0:
+        query(*self._delete_statement_for_rows(deleted)).close()
+      if len(created) > 0:
+        statement, values = self._insert_statement_for_rows(created)
+        returned.update(zip(created, query_values(statement, values)))
+      connect_to_db().commit()
+    except Exception:
+      connect_to_db().rollback()
+      raise
+    return returned
+
+  def _refetch_rows(self, id_values: List[int]) -> Dict[int, Tuple]:
+    id_name = self._schema[0].column_name
+    with query(self._select_statement(f" WHERE {id_name} = ANY(%s)"), [id_values]) as results:
+      return {row[0]: row for row in results}
+
+  def _needs_refetch(self, r: int) -> bool:
+    # FK display/auxiliary columns may be stale and need to be re-read through the joins
+    if len(self._fk_schema_indexes) == 0:
+      return False
+    changed_cells = self._changed_cells.get(r, ())
+    return bool(self._changed_rows[r] & ChangedState.CREATED) or any(i in changed_cells for i in self._fk_schema_indexes)
+
+  def _apply_saved(self, returned: Dict[int, Optional[Tuple]]) -> None:
+    # The save is committed at this point; FK labels are re-read by a separate job so that
+    # cancelling it cannot lose the saved state
+    refetch = [values[0] for r, values in returned.items() if values is not None and self._needs_refetch(r)]
+    last_column = self.columnCount(None) - 1
+    for r, values in returned.items():
+      if values is None:
         continue
-      if self._changed_row[i] & ChangedState.DELETED:
-        statements.append(self._delete_statement_for_row(row))
-      if self._changed_row[i] & ChangedState.CREATED:
-        statements.append(self._insert_statement_for_row(row))
-      if self._changed_row[i] & ChangedState.UPDATED:
-        statements.append(self._update_statement_for_row(row, self._changed[i]))
-
-    for sql, fields in statements:
-      query(sql, fields)
-    
-    conn = connect_to_db()
-    conn.commit()
+      for i, value in zip(self._base_schema_indexes, values):
+        self._store.set(r, i, value)
+      del self._changed_rows[r]
+      self._changed_cells.pop(r, None)
+      self.dataChanged.emit(self.index(r, 0), self.index(r, last_column))
+
+    removed = [r for r, state in self._changed_rows.items() if state & ChangedState.DELETED]
+    removed += [r for r, values in returned.items() if values is None]
+    self._remove_rows(removed)
+    self._busy = False
+    self.clearError()
+    self.saved.emit()
+    if len(refetch) > 0:
+      self._pool.submit(lambda: self._refetch_rows(refetch), self._apply_refetched, self.onError, lambda: self.onError("Query cancelled"))
+
+  def _apply_refetched(self, fetched: Dict[int, Tuple]) -> None:
+    for row in fetched.values():
+      self._add_fk_labels(self._fk_labels, row, True)
+    if self.rowCount(None) > 0:
+      self.dataChanged.emit(self.index(0, 0), self.index(self.rowCount(None) - 1, self.columnCount(None) - 1))
+
+  def _remove_rows(self, rows: List[int]) -> None:
+    # Remove from the bottom up in contiguous ranges so earlier indexes stay valid
+    removed = sorted(set(rows))
+    rows = removed[::-1]
+    while len(rows) > 0:
+      last = first = rows.pop(0)
+      while len(rows) > 0 and rows[0] == first - 1:
+        first = rows.pop(0)
+      self.beginRemoveRows(QModelIndex(), first, last)
+      self._store.delete(first, last)
+      self.endRemoveRows()
+
+    # Shift the tracked changes of the remaining rows up past the removed ones
+    removed_set = set(removed)
+    self._changed_rows = {r - bisect_left(removed, r): state for r, state in self._changed_rows.items() if r not in removed_set}
+    self._changed_cells = {r - bisect_left(removed, r): cells for r, cells in self._changed_cells.items() if r not in removed_set}
 
   def save(self) -> None:
-    self.beginResetModel()
-    try:
-      self._flush_changes()
-      self._make_query()
-      self._resetChanged()
-      self.clearError()
-    except Exception as e:
-      self.onError(e)
-    finally:
-      self.endResetModel()
-
-  def _default_row(self) -> List[Union[str, int, float]]:
-    row = []
-    for column in self._schema:
-      values = []
-      values.append(column.default_value)
-      if column.is_fk():
-        for _ in range(len(column.fk_options.display_columns)):
-          values.append("")
-        for _ in range(len(column.fk_options.auxiliary_columns)):
-          values.append(None)
-      row.append(values)
-    return row
-
-  def appendRow(self) -> None:
-    rc = len(self._local_data)
-    self.beginInsertRows(QModelIndex(), rc, rc)
-    row = self._default_row()
-    self._local_data.append(row)
-    self._changed_row.append(ChangedState.CREATED)
-    self._changed.append([ChangedState.CREATED for _ in row])
+    if self._busy:
+      return
+    self._busy = True
+    self._pool.submit(self._flush_changes, self._apply_saved, self._on_job_error, self._on_job_cancelled)
+
+  def _default_row(self) -> List[Value]:
+    return [self._schema[i].default_value for i in self._base_schema_indexes]
+
+  def _append_rows(self, rows: List[List[Value]]) -> None:
+    rc = len(self._store)
+    self.beginInsertRows(QModelIndex(), rc, rc + len(rows) - 1)
+    for r, row in enumerate(rows, rc):
+      self._store.append(row)
+      self._changed_rows[r] = ChangedState.CREATED
     self.endInsertRows()
     self.clearError()
 
+  def appendRow(self) -> None:
+    if self._busy:
+      return
+    self._append_rows([self._default_row()])
+
+  def _import_schema_indexes(self) -> List[int]:
+    # The id is assigned by the database and read-only columns are left at their default
+    return [i for i in self._base_schema_indexes[1:] if self._schema[i].editable]
+
+  def _import_columns(self, header: List[str]) -> Optional[List[int]]:
+    # Schema indexes named by a header record, or None if the record is data
+    names = {}
+    for i in self._import_schema_indexes():
+      names[self._schema[i].header.lower()] = i
+      names[strip_table_name(self._schema[i].column_name).lower()] = i
+    columns = [names.get(name.strip().lower()) for name in header]
+    if any(c is None for c in columns):
+      return None
+    return columns
+
+  def _import_value(self, column: DisplaySchemaColumn, text: str, fk_indexes: Dict[ForeignKeySpecification, FkLabelIndex]) -> Union[Value, List[Value]]:
+    if column.is_fk():
+      options = fk_indexes[column.fk_options].resolve(text)
+      if len(options) == 0:
+        raise ValueError(f"'{text}' does not match any {column.header}")
+      if len(options) > 1:
+        ids = ", ".join([str(o[0]) for o in options[:5]]) + (", ..." if len(options) > 5 else "")
+        raise ValueError(f"'{text}' is ambiguous, it matches {len(options)} {column.header} ids ({ids})")
+      return list(options[0])
+    return self._parse_value(column, text)
+
+  @staticmethod
+  def _parse_value(column: DisplaySchemaColumn, text: str) -> Value:
+    if column.value_type not in (int, float):
+      return text
+    if text.strip() == "" and column.default_value is None:
+      return None
+    try:
+      return column.value_type(text.strip())
+    except ValueError:
+      raise ValueError(f"'{text}' is not a valid {column.value_type.__name__}")
+
+  def importRecords(self, records: List[List[str]], fk_indexes: Dict[ForeignKeySpecification, FkLabelIndex]) -> List[str]:
+    # Appends one created row per record (pasted or CSV, optionally starting with a header of
+    # column headers or names) and returns the problems found; rows are only appended if there
+    # are none. FK cells take display values, resolved through fk_indexes.
+    if self._busy:
+      return ["The table is busy"]
+    records = [(n, record) for n, record in enumerate(records, 1) if any(cell.strip() != "" for cell in record)]
+    if len(records) == 0:
+      return []
+    columns = self._import_columns(records[0][1])
+    if columns is not None:
+      records = records[1:]
+    else:
+      columns = self._import_schema_indexes()
+
+    errors = []
+    rows = []
+    for n, record in records:
+      if len(record) != len(columns):
+        errors.append(f"Line {n}: expected {len(columns)} values, got {len(record)}")
+        continue
+      row = self._default_row()
+      for i, text in zip(columns, record):
+        column = self._schema[i]
+        try:
+          value = self._import_value(column, text, fk_indexes)
+        except ValueError as e:
+          errors.append(f"Line {n}, {column.header}: {e}")
+          continue
+        if column.is_fk():
+          self._fk_labels[i][value[0]] = self._fk_label(i, value)
+          value = value[0]
+        row[i] = value
+      rows.append(row)
+
+    if len(errors) == 0 and len(rows) > 0:
+      self._append_rows(rows)
+    return errors
+
   def data(self, index, role) -> QVariant:
     if not index.isValid():
-      return QVariant()
+      return _NO_DATA
     if role == Qt.DisplayRole or role == Qt.EditRole:
       schema_column_index, aux_column_index = self._displayed_columns_to_schema[index.column()]
       schema_column = self._schema[schema_column_index]
 
-      raw_data = self._local_data[index.row()][schema_column_index]
       if schema_column.is_fk():
         if aux_column_index is not None:
-          return QVariant(raw_data[1 + len(schema_column.fk_options.display_columns) + aux_column_index])
+          return QVariant(self._fk_label_for(index.row(), schema_column_index)[1][aux_column_index])
         else:
           if role == Qt.DisplayRole:
-            display_columns_data = raw_data[1 : len(schema_column.fk_options.display_columns) + 1]
-            formatted = schema_column.fk_options.display_format.format(*display_columns_data)
-            return QVariant(formatted)
+            return QVariant(self._fk_label_for(index.row(), schema_column_index)[0])
           elif role == Qt.EditRole:
-            return QVariant(FkTableModelColumn(raw_data[0], schema_column))
+            return QVariant(FkTableModelColumn(self._store.get(index.row(), schema_column_index), schema_column))
       elif schema_column.isDeleteBtn:
         if role == Qt.DisplayRole:
-          return QVariant("Delete")
+          return _DELETE_TEXT
         elif role == Qt.EditRole:
-          return QVariant(raw_data[0])
+          return _DELETE_BUTTON
       else:
-        return QVariant(raw_data[0])
+        value = self._store.get(index.row(), schema_column_index)
+        if role == Qt.EditRole and schema_column.default_value is None:
+          # Edited as text so the cell can be cleared to NULL
+          return QVariant("" if value is None else str(value))
+        return QVariant(value)
 
     if role == Qt.BackgroundRole:
       schema_column_index, _ = self._displayed_columns_to_schema[index.column()]
-      deleted_row = self._changed_row[index.row()] & ChangedState.DELETED
-      created_row = self._changed_row[index.row()] & ChangedState.CREATED
-      updated = self._changed[index.row()][schema_column_index] & ChangedState.UPDATED
+      state = self._changed_rows.get(index.row(), ChangedState.NONE)
       uneditable = index.column() in self._uneditable_columns
 
-      if deleted_row:
-        if uneditable:
-          return QVariant(QBrush(QColor(0xbc, 0x54, 0x4b)))
-        else:
-          return QVariant(QBrush(QColor(0xff, 0x00, 0x00)))
-      elif created_row:
-        if uneditable:
-          return QVariant(QBrush(QColor(0x3d, 0xed, 0x97)))
-        else:
-          return QVariant(QBrush(QColor(0x99, 0xed, 0xc3)))
-      elif updated:
-        if uneditable:
-          return QVariant(QBrush(QColor(0x99, 0xbf, 0x00)))
-        else:
-          return QVariant(QBrush(QColor(0xdf, 0xff, 0x00)))
+      if state & ChangedState.DELETED:
+        return _DELETED_UNEDITABLE if uneditable else _DELETED
+      elif state & ChangedState.CREATED:
+        return _CREATED_UNEDITABLE if uneditable else _CREATED
+      elif state & ChangedState.UPDATED and schema_column_index in self._changed_cells.get(index.row(), ()):
+        return _UPDATED_UNEDITABLE if uneditable else _UPDATED
       else:
-        if uneditable:
-          return QVariant(QBrush(QColor(0xe6, 0xe6, 0xe6)))
-        else:
-          return QVariant()
+        return _UNEDITABLE if uneditable else _NO_DATA
 
-    return QVariant()
+    return _NO_DATA
 
   def flags(self, index):
-    if index.column() in self._uneditable_columns:
+    if self._busy or index.column() in self._uneditable_columns:
       return Qt.ItemIsEnabled | Qt.ItemIsSelectable
-    return Qt.ItemIsSelectable | Qt.ItemIsEnabled | Qt.ItemIsEditable
\ No newline at end of file
+    return Qt.ItemIsSelectable | Qt.ItemIsEnabled | Qt.ItemIsEditable
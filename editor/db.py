@@ -1,20 +1,26 @@
 import psycopg2
+from psycopg2.extras import execute_values
 from psycopg2.extensions import connection as pg_connection, cursor as pg_cursor
 import os
-from typing import Iterable, Optional, List
+from typing import Dict, Iterable, List, Set, Tuple
 import logging
+import threading
+import hashlib
+import itertools
+import json
 import argparse
 import textwrap
 from dotenv import load_dotenv, find_dotenv
 
 load_dotenv(find_dotenv())
 
-parser = argparse.ArgumentParser()
+# Shared by the editor and the command line tools, which extend it (see dispatcher.py)
+parser = argparse.ArgumentParser(add_help=False)
 parser.add_argument("-log", "--log", 
   default="WARNING", 
   help=("Provide logging level: CRITICAL, ERROR, WARNING, INFO DEBUG. default=WARNING"),
 )
-options = parser.parse_args()
+options, _ = parser.parse_known_args()
 numeric_level = getattr(logging, options.log.upper(), None)
 if not isinstance(numeric_level, int):
   raise ValueError('Invalid log level: %s' % options.log.upper())
@@ -22,24 +28,39 @@ logging.basicConfig(level=numeric_level)
 
 logger = logging.getLogger(__name__)
 
-connection: Optional[pg_connection] = None
+# Each thread (the GUI thread and every worker of DbWorkerPool) owns a dedicated connection
+_local = threading.local()
+_connections: List[pg_connection] = []
+_connections_lock = threading.Lock()
 
 
 def connect_to_db() -> pg_connection:
-  global connection
+  connection = getattr(_local, 'connection', None)
   if (connection is None):
     connection = psycopg2.connect(host='localhost',
                                   database=os.getenv('DB_DATABASE'),
                                   user=os.getenv('DB_USERNAME'),
                                   password=os.getenv('DB_PASSWORD'))
+    _local.connection = connection
+    with _connections_lock:
+      _connections.append(connection)
   return connection
 
 
 def close_db_connection() -> None:
-  global connection
+  connection = getattr(_local, 'connection', None)
   if (connection is not None):
+    with _connections_lock:
+      _connections.remove(connection)
     connection.close()
-    connection = None
+    _local.connection = None
+
+
+def close_all_db_connections() -> None:
+  with _connections_lock:
+    for connection in _connections:
+      connection.close()
+    _connections.clear()
 
 
 def query(q: str, params: Iterable = []) -> pg_cursor:
@@ -54,6 +75,38 @@ def query(q: str, params: Iterable = []) -> pg_cursor:
     raise Exception('Error executing query: {} {}\ncaused by: {}'.format(q, params, e)) from e
 
 
+_stream_names = itertools.count()
+
+
+def stream_query(q: str, params: Iterable = [], itersize: int = 10000) -> pg_cursor:
+  # Server-side cursor: iterating it transfers itersize rows at a time instead of the whole result
+  try:
+    connection = connect_to_db()
+    _query = textwrap.dedent(q).strip()
+    logger.debug('Executing query: %s %s', _query, params)
+    cur = connection.cursor(name=f'stream_{next(_stream_names)}')
+    cur.itersize = itersize
+    cur.execute(_query, params)
+    return cur
+  except Exception as e:
+    raise Exception('Error executing query: {} {}\ncaused by: {}'.format(q, params, e)) from e
+
+
+def query_values(q: str, rows: List[Iterable], page_size: int = 1000) -> List[Tuple]:
+  # Expands the single VALUES %s placeholder in q to all rows, page_size rows per statement, and
+  # returns the rows of its RETURNING clause in the order of the input
+  try:
+    connection = connect_to_db()
+    _query = textwrap.dedent(q).strip()
+    logger.debug('Executing query: %s (%d rows)', _query, len(rows))
+    cur = connection.cursor()
+    results = execute_values(cur, _query, rows, page_size=page_size, fetch=True)
+    cur.close()
+    return results
+  except Exception as e:
+    raise Exception('Error executing query: {} ({} rows)\ncaused by: {}'.format(q, len(rows), e)) from e
+
+
 class ColumnDefinition():
   def __init__(self, name: str, data_type: str, constraints: List[str] = []):
     self.name = name
@@ -85,6 +138,15 @@ class BaseTable():
       );
     """).strip()
 
+  def _add_columns(self, existing: Set[str]) -> str:
+    # Adds the columns a table created by an older version lacks; existing holds lower case names
+    # as in the catalog. Empty if none are missing, so up to date tables are never locked.
+    missing = [c for c in self._columns() if c.name.lower() not in existing]
+    if len(missing) == 0:
+      return ""
+    added = ",\n  ".join([f"ADD COLUMN {c}" for c in missing])
+    return f"ALTER TABLE {self.table_name()}\n  {added};"
+
   def _create_table(self) -> None:
     connection = connect_to_db()
     query = self._schema()
@@ -93,9 +155,6 @@ class BaseTable():
     cur.execute(query)
     cur.close()
 
-  def __init__(self) -> None:
-    self._create_table()
-
   def truncate(self) -> None:
     connection = connect_to_db()
     query = f"""DELETE FROM {self.table_name()};"""
@@ -145,6 +204,7 @@ class HubTable(BaseTable):
       ColumnDefinition('label', 'TEXT', []),
       ColumnDefinition('posX', 'FLOAT', ['NOT NULL']),
       ColumnDefinition('posY', 'FLOAT', ['NOT NULL']),
+      ColumnDefinition('capacity', 'INTEGER', []),
     ]
 
 
@@ -157,6 +217,7 @@ class PathTable(BaseTable):
       ColumnDefinition('path_id', 'SERIAL', ['PRIMARY KEY']),
       ColumnDefinition('start_hub_id', 'INTEGER', ['NOT NULL']),
       ColumnDefinition('end_hub_id', 'INTEGER', ['NOT NULL']),
+      ColumnDefinition('capacity', 'INTEGER', []),
     ]
 
   def _ddl_clauses(self) -> List[str]:
@@ -184,3 +245,110 @@ class MovementTable(BaseTable):
       'CONSTRAINT fk_movement_path FOREIGN KEY(path_id) REFERENCES path(path_id)',
     ]
 
+
+class TransportRequestTable(BaseTable):
+  def table_name(self) -> str:
+    return 'transport_request'
+
+  def _columns(self) -> List[ColumnDefinition]:
+    return [
+      ColumnDefinition('request_id', 'SERIAL', ['PRIMARY KEY']),
+      ColumnDefinition('origin_hub_id', 'INTEGER', ['NOT NULL']),
+      ColumnDefinition('destination_hub_id', 'INTEGER', ['NOT NULL']),
+      ColumnDefinition('ready_ts', 'BIGINT', ['NOT NULL', 'DEFAULT 0']),
+      ColumnDefinition('due_ts', 'BIGINT', []),
+      ColumnDefinition('vehicle_id', 'INTEGER', []),
+      ColumnDefinition('pickup_ts', 'BIGINT', []),
+      ColumnDefinition('delivery_ts', 'FLOAT', []),
+    ]
+
+  def _ddl_clauses(self) -> List[str]:
+    return [
+      'CONSTRAINT fk_transport_request_origin FOREIGN KEY(origin_hub_id) REFERENCES hub(hub_id)',
+      'CONSTRAINT fk_transport_request_destination FOREIGN KEY(destination_hub_id) REFERENCES hub(hub_id)',
+      'CONSTRAINT fk_transport_request_vehicle FOREIGN KEY(vehicle_id) REFERENCES vehicle(vehicle_id)',
+      'CONSTRAINT transport_request_distinct_hubs CHECK (origin_hub_id <> destination_hub_id)',
+    ]
+
+
+def all_tables() -> List[BaseTable]:
+  # In dependency order
+  return [ModelTable(), VehicleTable(), HubTable(), PathTable(), MovementTable(), TransportRequestTable()]
+
+
+
+SCHEMA_CACHE_PATH = os.path.join(os.path.dirname(__file__), '.schema_cache.json')
+
+
+def catalog_columns(table_names: List[str]) -> Dict[str, Set[str]]:
+  with query("""
+    SELECT table_name, column_name
+    FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = ANY(%s);
+  """, [table_names]) as results:
+    columns = {}
+    for table_name, column_name in results:
+      columns.setdefault(table_name, set()).add(column_name)
+    return columns
+
+
+def catalog_fingerprint(table_names: List[str]) -> str:
+  with query("""
+    SELECT md5(COALESCE(string_agg(
+      table_name || '.' || column_name || ' ' || data_type || ' ' || is_nullable, ','
+      ORDER BY table_name, ordinal_position
+    ), ''))
+    FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = ANY(%s);
+  """, [table_names]) as results:
+    return results.fetchone()[0]
+
+
+def _read_schema_cache() -> Dict[str, Dict[str, str]]:
+  try:
+    with open(SCHEMA_CACHE_PATH) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return {}
+
+
+def _write_schema_cache(cache: Dict[str, Dict[str, str]]) -> None:
+  try:
+    with open(SCHEMA_CACHE_PATH, 'w') as f:
+      json.dump(cache, f, indent=2)
+  except OSError as e:
+    logger.warning('Could not write schema cache %s: %s', SCHEMA_CACHE_PATH, e)
+
+
+# Creates missing tables and columns in a single round trip, unless the catalog still matches the
+# fingerprint recorded the last time these definitions were checked. Returns whether any DDL was
+# executed. DDL is only sent for tables that need it: it waits for the locks of every open
+# transaction that read the table, e.g. other editors and the visualizer.
+# The transaction is always ended, so no locks are kept on the checked tables.
+def ensure_schema(tables: List[BaseTable]) -> bool:
+  table_names = [t.table_name() for t in tables]
+  ddl = "\n".join([t._schema() for t in tables])
+  ddl_hash = hashlib.md5(ddl.encode()).hexdigest()
+  cache_key = f"{os.getenv('DB_DATABASE')}@localhost"
+
+  cache = _read_schema_cache()
+  cached = cache.get(cache_key, {})
+  try:
+    fingerprint = catalog_fingerprint(table_names)
+    if cached.get('ddl') == ddl_hash and cached.get('catalog') == fingerprint:
+      logger.debug('Schema fingerprint %s matches cache, skipping DDL', fingerprint)
+      connect_to_db().rollback()
+      return False
+
+    existing = catalog_columns(table_names)
+    statements = [t._add_columns(existing[t.table_name()]) if t.table_name() in existing else t._schema() for t in tables]
+    statements = [s for s in statements if s != ""]
+    if len(statements) > 0:
+      query("\n".join(statements)).close()
+    cache[cache_key] = {'ddl': ddl_hash, 'catalog': catalog_fingerprint(table_names)}
+    connect_to_db().commit()
+  except Exception:
+    connect_to_db().rollback()
+    raise
+  _write_schema_cache(cache)
+  return len(statements) > 0
@@ -0,0 +1,283 @@
+import argparse
+import math
+import time
+from collections import defaultdict
+from heapq import heappush, heappop
+from typing import Dict, List, Optional, Tuple
+from db import parser as db_parser, query, query_values, connect_to_db, close_db_connection, ensure_schema, all_tables, logger
+
+# Assigns unassigned transport requests to vehicles and appends the resulting movements.
+#
+# Every vehicle continues from the end hub and arrival time of its last movement, so existing
+# movements and assignments are never changed: running the dispatcher again after new requests
+# arrive only plans those requests, on top of the current plan.
+#   python dispatcher.py [--dry-run]
+
+Hop = Tuple[int, float]  # (path_id, length)
+Movement = Tuple[int, int, int]  # (ts, vehicle_id, path_id), as inserted into movement
+
+
+class Network:
+  # Shortest paths over `path`, with hub distances as edge lengths. Travel time is length / speed
+  # for every model, so one shortest path tree per destination hub serves all models; trees are
+  # built on first use and cached.
+  def __init__(self, hubs: Dict[int, Tuple[float, float]], paths: List[Tuple[int, int, int]]) -> None:
+    self._incoming: Dict[int, List[Tuple[int, float, int]]] = defaultdict(list)
+    for path_id, start_hub_id, end_hub_id in paths:
+      (x1, y1), (x2, y2) = hubs[start_hub_id], hubs[end_hub_id]
+      self._incoming[end_hub_id].append((start_hub_id, math.hypot(x2 - x1, y2 - y1), path_id))
+    # {destination: ({hub: distance to destination}, {hub: first hop toward destination})}
+    self._trees: Dict[int, Tuple[Dict[int, float], Dict[int, Tuple[int, float, int]]]] = {}
+    self._by_distance: Dict[int, List[Tuple[float, int]]] = {}
+
+  def _tree(self, destination: int) -> Tuple[Dict[int, float], Dict[int, Tuple[int, float, int]]]:
+    tree = self._trees.get(destination)
+    if tree is None:
+      # Dijkstra backwards from the destination over incoming paths
+      distances = {destination: 0.}
+      next_hops = {}
+      heap = [(0., destination)]
+      while len(heap) > 0:
+        distance, hub = heappop(heap)
+        if distance > distances[hub]:
+          continue
+        for start_hub_id, length, path_id in self._incoming[hub]:
+          d = distance + length
+          if d < distances.get(start_hub_id, math.inf):
+            distances[start_hub_id] = d
+            next_hops[start_hub_id] = (path_id, length, hub)
+            heappush(heap, (d, start_hub_id))
+      tree = self._trees[destination] = (distances, next_hops)
+    return tree
+
+  def distance(self, start: int, destination: int) -> float:
+    return self._tree(destination)[0].get(start, math.inf)
+
+  def hubs_by_distance(self, destination: int) -> List[Tuple[float, int]]:
+    # (distance, hub) for every hub that can reach destination, nearest first
+    hubs = self._by_distance.get(destination)
+    if hubs is None:
+      hubs = self._by_distance[destination] = sorted((d, hub) for hub, d in self._tree(destination)[0].items())
+    return hubs
+
+  def route(self, start: int, destination: int) -> List[Hop]:
+    next_hops = self._tree(destination)[1]
+    hops = []
+    hub = start
+    while hub != destination:
+      path_id, length, hub = next_hops[hub]
+      hops.append((path_id, length))
+    return hops
+
+
+class Vehicle:
+  def __init__(self, vehicle_id: int, model_id: int, speed: float, hub_id: int, free_at: float, last_ts: int) -> None:
+    self.vehicle_id = vehicle_id
+    self.model_id = model_id
+    self.speed = speed
+    # Where and from when the vehicle is idle, and the ts of its last departure
+    self.hub_id = hub_id
+    self.free_at = free_at
+    self.last_ts = last_ts
+
+  def drive(self, hops: List[Hop], depart_at: float, last_ts: int, movements: List[Movement]) -> Tuple[float, int]:
+    # Appends one movement per hop, departing at integer timestamps as soon as possible after
+    # depart_at and last_ts; returns the arrival time and the ts of the last departure
+    t = depart_at
+    for path_id, length in hops:
+      ts = max(math.ceil(t), last_ts + 1)
+      movements.append((ts, self.vehicle_id, path_id))
+      last_ts = ts
+      t = ts + length / self.speed
+    return t, last_ts
+
+
+class TransportRequest:
+  def __init__(self, request_id: int, origin_hub_id: int, destination_hub_id: int, ready_ts: int, due_ts: Optional[int]) -> None:
+    self.request_id = request_id
+    self.origin_hub_id = origin_hub_id
+    self.destination_hub_id = destination_hub_id
+    self.ready_ts = ready_ts
+    self.due_ts = due_ts
+
+
+class Assignment:
+  def __init__(self, request: TransportRequest, vehicle_id: int, pickup_ts: int, delivery_ts: float, movements: List[Movement]) -> None:
+    self.request = request
+    self.vehicle_id = vehicle_id
+    self.pickup_ts = pickup_ts
+    self.delivery_ts = delivery_ts
+    self.movements = movements
+
+
+class Dispatcher:
+  # Greedy assignment: requests are taken in order of ready_ts and each goes to the vehicle that
+  # can deliver it earliest. Idle vehicles are kept in a min-heap of free time per (hub, model),
+  # so only the top of each heap is a candidate, and hubs are scanned nearest first per model,
+  # stopping once even the earliest free vehicle of that model could not beat the best so far.
+  def __init__(self, network: Network, vehicles: List[Vehicle]) -> None:
+    self.network = network
+    self.vehicles = {v.vehicle_id: v for v in vehicles}
+    self._idle: Dict[Tuple[int, int], List[Tuple[float, int]]] = defaultdict(list)
+    # Per model, a lower bound heap of free times; entries of vehicles that moved on are stale
+    self._model_free: Dict[int, List[Tuple[float, int]]] = defaultdict(list)
+    self._speeds: Dict[int, float] = {}
+    for v in vehicles:
+      self._park(v)
+      self._speeds[v.model_id] = v.speed
+
+  def _park(self, v: Vehicle) -> None:
+    heappush(self._idle[(v.hub_id, v.model_id)], (v.free_at, v.vehicle_id))
+    heappush(self._model_free[v.model_id], (v.free_at, v.vehicle_id))
+
+  def _earliest_free(self, model_id: int) -> float:
+    heap = self._model_free[model_id]
+    while len(heap) > 0 and heap[0][0] != self.vehicles[heap[0][1]].free_at:
+      heappop(heap)
+    return heap[0][0] if len(heap) > 0 else math.inf
+
+  def _best_vehicle(self, request: TransportRequest, delivery_distance: float) -> Optional[Vehicle]:
+    best: Tuple[float, int] = (math.inf, 0)
+    hubs = self.network.hubs_by_distance(request.origin_hub_id)
+    for model_id, speed in self._speeds.items():
+      earliest_free = self._earliest_free(model_id)
+      delivery_time = delivery_distance / speed
+      for distance, hub_id in hubs:
+        travel_time = distance / speed
+        if max(request.ready_ts, earliest_free + travel_time) + delivery_time >= best[0]:
+          break
+        idle = self._idle.get((hub_id, model_id))
+        if not idle:
+          continue
+        free_at, vehicle_id = idle[0]
+        candidate = (max(request.ready_ts, free_at + travel_time) + delivery_time, vehicle_id)
+        if candidate < best:
+          best = candidate
+    return self.vehicles[best[1]] if best[1] in self.vehicles else None
+
+  def assign(self, request: TransportRequest) -> Tuple[Optional[Assignment], str]:
+    delivery_distance = self.network.distance(request.origin_hub_id, request.destination_hub_id)
+    if math.isinf(delivery_distance):
+      return None, 'destination unreachable from origin'
+    v = self._best_vehicle(request, delivery_distance)
+    if v is None:
+      return None, 'no vehicle can reach the origin'
+
+    movements = []
+    at_origin, last_ts = v.drive(self.network.route(v.hub_id, request.origin_hub_id), v.free_at, v.last_ts, movements)
+    pickup_ts = max(math.ceil(max(at_origin, request.ready_ts)), last_ts + 1)
+    delivered_at, last_ts = v.drive(self.network.route(request.origin_hub_id, request.destination_hub_id), pickup_ts, last_ts, movements)
+    if request.due_ts is not None and delivered_at > request.due_ts:
+      return None, f'earliest delivery at {delivered_at:.1f} is after due_ts {request.due_ts}'
+
+    heappop(self._idle[(v.hub_id, v.model_id)])
+    v.hub_id = request.destination_hub_id
+    v.free_at = delivered_at
+    v.last_ts = last_ts
+    self._park(v)
+    return Assignment(request, v.vehicle_id, pickup_ts, delivered_at, movements), ''
+
+  def plan(self, requests: List[TransportRequest]) -> Tuple[List[Assignment], List[Tuple[TransportRequest, str]]]:
+    assignments = []
+    unassigned = []
+    for request in sorted(requests, key=lambda r: (r.ready_ts, r.request_id)):
+      assignment, reason = self.assign(request)
+      if assignment is None:
+        unassigned.append((request, reason))
+      else:
+        assignments.append(assignment)
+    return assignments, unassigned
+
+
+def load_network() -> Network:
+  with query("SELECT hub_id, posX, posY FROM hub;") as results:
+    hubs = {hub_id: (x, y) for hub_id, x, y in results}
+  with query("SELECT path_id, start_hub_id, end_hub_id FROM path;") as results:
+    paths = results.fetchall()
+  return Network(hubs, paths)
+
+
+def load_vehicles() -> List[Vehicle]:
+  # Vehicles without movements have no known position and are not dispatched
+  with query("""
+    SELECT DISTINCT ON (MWA.vehicle_id) MWA.vehicle_id, V.model_id, MDL.speed, P.end_hub_id, MWA.arrival_time, MWA.ts
+    FROM movement_with_arrival MWA
+    JOIN path P ON MWA.path_id = P.path_id
+    JOIN vehicle V ON MWA.vehicle_id = V.vehicle_id
+    JOIN model MDL ON V.model_id = MDL.model_id
+    WHERE MDL.speed > 0
+    ORDER BY MWA.vehicle_id, MWA.ts DESC;
+  """) as results:
+    return [Vehicle(*row) for row in results]
+
+
+def count_unplaced_vehicles() -> int:
+  # Vehicles skipped by load_vehicles because they have no movement to start from
+  with query("SELECT COUNT(*) FROM vehicle V WHERE NOT EXISTS (SELECT 1 FROM movement M WHERE M.vehicle_id = V.vehicle_id);") as results:
+    return results.fetchone()[0]
+
+
+def load_unassigned_requests() -> List[TransportRequest]:
+  # Locked until commit, so concurrent runs cannot assign the same requests twice
+  with query("""
+    SELECT request_id, origin_hub_id, destination_hub_id, ready_ts, due_ts
+    FROM transport_request
+    WHERE vehicle_id IS NULL
+    ORDER BY ready_ts, request_id
+    FOR UPDATE;
+  """) as results:
+    return [TransportRequest(*row) for row in results]
+
+
+def save_assignments(assignments: List[Assignment]) -> None:
+  movements = [m for a in assignments for m in a.movements]
+  if len(movements) > 0:
+    query_values("INSERT INTO movement (ts, vehicle_id, path_id) VALUES %s RETURNING movement_id;", movements)
+  if len(assignments) > 0:
+    query_values("""
+      UPDATE transport_request AS R
+      SET vehicle_id = A.vehicle_id, pickup_ts = A.pickup_ts, delivery_ts = A.delivery_ts
+      FROM (VALUES %s) AS A(request_id, vehicle_id, pickup_ts, delivery_ts)
+      WHERE R.request_id = A.request_id
+      RETURNING R.request_id;
+    """, [(a.request.request_id, a.vehicle_id, a.pickup_ts, a.delivery_ts) for a in assignments])
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Assign unassigned transport requests to vehicles.", parents=[db_parser])
+  parser.add_argument("--dry-run", action="store_true", help="plan and report without saving")
+  options = parser.parse_args()
+
+  ensure_schema(all_tables())
+  connection = connect_to_db()
+  try:
+    started = time.perf_counter()
+    requests = load_unassigned_requests()
+    dispatcher = Dispatcher(load_network(), load_vehicles())
+    unplaced = count_unplaced_vehicles()
+    loaded = time.perf_counter()
+    assignments, unassigned = dispatcher.plan(requests)
+    planned = time.perf_counter()
+    if options.dry_run:
+      connection.rollback()
+    else:
+      save_assignments(assignments)
+      connection.commit()
+    saved = time.perf_counter()
+  except Exception:
+    connection.rollback()
+    raise
+  finally:
+    close_db_connection()
+
+  for request, reason in unassigned:
+    logger.warning('Request %d not assigned: %s', request.request_id, reason)
+  print(f"{len(assignments)} of {len(requests)} requests assigned to {len(set(a.vehicle_id for a in assignments))} of {len(dispatcher.vehicles)} vehicles, "
+        f"{sum(len(a.movements) for a in assignments)} movements{' (dry run)' if options.dry_run else ''}")
+  if unplaced > 0:
+    print(f"{unplaced} vehicle(s) without movements were not dispatched: a vehicle's hub is only known from its last movement, so add a first movement to place it")
+  print(f"load {loaded - started:.2f}s, plan {planned - loaded:.2f}s, save {saved - planned:.2f}s")
+
+
+if __name__ == '__main__':
+  main()
@@ -1,11 +1,15 @@
 import sys
 import os
+import csv
+import io
+from typing import Dict, List
 from PyQt5 import uic
 from PyQt5.QtCore import Qt
-from PyQt5.QtWidgets import QApplication, QMainWindow, QStyleFactory, QGridLayout, QPushButton, QTableView, QWidget, QHeaderView
-from FkTableModel import FkTableModel, DisplaySchemaColumn, ForeignKeySpecification, AuxiliaryColumn
-from db import ModelTable, VehicleTable, HubTable, PathTable, MovementTable, logger
-from FkColumnDelegate import FkColumnDelegate
+from PyQt5.QtWidgets import QApplication, QMainWindow, QStyleFactory, QGridLayout, QPushButton, QTableView, QWidget, QHeaderView, QFileDialog, QMessageBox
+from FkTableModel import FkTableModel, DisplaySchemaColumn, ForeignKeySpecification, AuxiliaryColumn, FkLabelIndex
+from db import ModelTable, VehicleTable, HubTable, PathTable, MovementTable, TransportRequestTable, all_tables, ensure_schema, logger
+from FkColumnDelegate import FkColumnDelegate, FkOptionsCache
+from DbWorkerPool import DbWorkerPool
 
 QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)  # enable highdpi scaling
 QApplication.setAttribute(Qt.AA_UseHighDpiPixmaps, True)  # use highdpi icons
@@ -17,6 +21,11 @@ class MainWindow(QMainWindow, Ui_Interface):
     super().__init__(parent)
     self.setupUi(self)
 
+    self.db_pool = DbWorkerPool(parent=self)
+    self.db_pool.busy_changed.connect(self.setBusy)
+    self.cancel_btn.clicked.connect(self.db_pool.cancel_all)
+    self.setBusy(False)
+
     self.models = [
       FkTableModel(
         table_name=ModelTable().table_name(),
@@ -28,6 +37,7 @@ class MainWindow(QMainWindow, Ui_Interface):
         ],
         onError=self.setErrorLabel,
         clearError=self.clearErrorLabel,
+        pool=self.db_pool,
       ),
       FkTableModel(
         table_name=VehicleTable().table_name(),
@@ -48,6 +58,7 @@ class MainWindow(QMainWindow, Ui_Interface):
         ],
         onError=self.setErrorLabel,
         clearError=self.clearErrorLabel,
+        pool=self.db_pool,
       ),
       FkTableModel(
         table_name=HubTable().table_name(),
@@ -59,6 +70,7 @@ class MainWindow(QMainWindow, Ui_Interface):
         ],
         onError=self.setErrorLabel,
         clearError=self.clearErrorLabel,
+        pool=self.db_pool,
       ),
       FkTableModel(
         table_name=PathTable().table_name(),
@@ -83,6 +95,7 @@ class MainWindow(QMainWindow, Ui_Interface):
         ],
         onError=self.setErrorLabel,
         clearError=self.clearErrorLabel,
+        pool=self.db_pool,
       ),
       FkTableModel(
         table_name=MovementTable().table_name(),
@@ -110,17 +123,57 @@ class MainWindow(QMainWindow, Ui_Interface):
         ],
         onError=self.setErrorLabel,
         clearError=self.clearErrorLabel,
-      )
+        pool=self.db_pool,
+      ),
+      FkTableModel(
+        table_name=TransportRequestTable().table_name(),
+        schema=[
+          DisplaySchemaColumn(column_name="transport_request.request_id", header="id", default_value=None),
+          DisplaySchemaColumn(column_name="transport_request.origin_hub_id", header="origin", default_value=0,
+            fk_options=ForeignKeySpecification(
+              reference_table="hub AS o_hub", 
+              join_on="transport_request.origin_hub_id = o_hub.hub_id", 
+              foreign_column_name="o_hub.hub_id",
+              display_columns=["o_hub.label"]
+            )
+          ),
+          DisplaySchemaColumn(column_name="transport_request.destination_hub_id", header="destination", default_value=0,
+            fk_options=ForeignKeySpecification(
+              reference_table="hub AS d_hub", 
+              join_on="transport_request.destination_hub_id = d_hub.hub_id", 
+              foreign_column_name="d_hub.hub_id",
+              display_columns=["d_hub.label"]
+            )
+          ),
+          DisplaySchemaColumn(column_name="transport_request.ready_ts", header="ready", default_value=0),
+          DisplaySchemaColumn(column_name="transport_request.due_ts", header="due", default_value=None),
+          # Filled in by dispatcher.py
+          DisplaySchemaColumn(column_name="transport_request.vehicle_id", header="vehicle", default_value=None, editable=False,
+            fk_options=ForeignKeySpecification(
+              reference_table="vehicle AS a_vehicle", 
+              join_on="transport_request.vehicle_id = a_vehicle.vehicle_id", 
+              foreign_column_name="a_vehicle.vehicle_id",
+              display_columns=["a_vehicle.label"]
+            )
+          ),
+          DisplaySchemaColumn(column_name="transport_request.pickup_ts", header="pickup", default_value=None, editable=False),
+          DisplaySchemaColumn(column_name="transport_request.delivery_ts", header="delivery", default_value=None, editable=False, value_type=float),
+        ],
+        onError=self.setErrorLabel,
+        clearError=self.clearErrorLabel,
+        pool=self.db_pool,
+      ),
     ]
 
-    self.fk_column_delegate = FkColumnDelegate()
+    self.fk_options_cache = FkOptionsCache(self.db_pool, parent=self)
+    self.fk_column_delegate = FkColumnDelegate(self.fk_options_cache)
 
     for model in self.models:
       tab = QWidget()
       layout = QGridLayout()
       tab.setLayout(layout)
       clearBtn = QPushButton("Clear and Refresh", tab)
-      clearBtn.clicked.connect(model.reset)
+      clearBtn.clicked.connect(lambda _, model=model: self.refreshTab(model))
       layout.addWidget(clearBtn, 1, 0)
 
       saveBtn = QPushButton("Save Changes", tab)
@@ -131,13 +184,22 @@ class MainWindow(QMainWindow, Ui_Interface):
       addBtn.clicked.connect(model.appendRow)
       layout.addWidget(addBtn, 1, 2)
 
+      pasteBtn = QPushButton("Paste Rows", tab)
+      pasteBtn.clicked.connect(lambda _, model=model: self.pasteRows(model))
+      layout.addWidget(pasteBtn, 1, 3)
+
+      importBtn = QPushButton("Import CSV", tab)
+      importBtn.clicked.connect(lambda _, model=model: self.importCsv(model))
+      layout.addWidget(importBtn, 1, 4)
+
       view = QTableView(tab)
       view.setModel(model)
       view.setItemDelegate(self.fk_column_delegate)
       view.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
-      layout.addWidget(view, 0, 0, 1, 3)
+      layout.addWidget(view, 0, 0, 1, 5)
     
       self.tabWidget.addTab(tab, model.table_name)
+      model.saved.connect(self.refreshReferenceData)
 
       # for r in range(self.vehicleModel.rowCount(None)):
       #   res = self.vehicleTableView.openPersistentEditor(self.vehicleModel.index(r, 2))
@@ -151,6 +213,93 @@ class MainWindow(QMainWindow, Ui_Interface):
       # self.modelTableView.resizeColumnsToContents()
       # self.vehicleTableView.resizeColumnsToContents()
 
+    # Tables are only queried once their tab is first shown, after the schema has been checked
+    self._schema_ready = False
+    self.tabWidget.currentChanged.connect(self.loadTab)
+    tables = all_tables()
+    self.db_pool.submit(lambda: ensure_schema(tables), self.onSchemaReady, self.onSchemaFailed, lambda: self.onSchemaReady(False))
+
+  def onSchemaReady(self, created: bool) -> None:
+    if created:
+      logger.info('Schema updated')
+    self._schema_ready = True
+    self.loadTab(self.tabWidget.currentIndex())
+    self.prefetchReferenceData()
+
+  def onSchemaFailed(self, e) -> None:
+    # The tables may well exist (e.g. no permission for DDL), so load them anyway; if not, each
+    # tab reports its own error and can be retried with "Clear and Refresh"
+    self.setErrorLabel(e)
+    self.onSchemaReady(False)
+
+  def loadTab(self, index: int) -> None:
+    if self._schema_ready and 0 <= index < len(self.models):
+      self.models[index].ensure_loaded()
+
+  def prefetchReferenceData(self) -> None:
+    for model in self.models:
+      for fk_options in model.foreign_keys():
+        self.fk_options_cache.prefetch(fk_options)
+
+  def refreshTab(self, model: FkTableModel) -> None:
+    # Rows referenced by this tab may have been added or changed by other clients (or dispatcher.py)
+    for fk_options in model.foreign_keys():
+      self.fk_options_cache.invalidate(fk_options)
+      self.fk_options_cache.prefetch(fk_options)
+    model.reset()
+
+  def refreshReferenceData(self) -> None:
+    self.fk_options_cache.invalidate()
+    self.prefetchReferenceData()
+
+  def pasteRows(self, model: FkTableModel) -> None:
+    # Rows copied from a spreadsheet are tab separated
+    text = QApplication.clipboard().text()
+    delimiter = "\t" if "\t" in text else ","
+    self.importRecords(model, list(csv.reader(io.StringIO(text), delimiter=delimiter)))
+
+  def importCsv(self, model: FkTableModel) -> None:
+    path, _ = QFileDialog.getOpenFileName(self, f"Import {model.table_name}", "", "CSV files (*.csv);;All files (*)")
+    if path == "":
+      return
+    try:
+      with open(path, newline="", encoding="utf-8-sig") as f:
+        records = list(csv.reader(f))
+    except (OSError, UnicodeDecodeError, csv.Error) as e:
+      self.setErrorLabel(e)
+      return
+    self.importRecords(model, records)
+
+  def importRecords(self, model: FkTableModel, records: List[List[str]]) -> None:
+    # Waits for the label index of every FK of the table, then resolves all records at once; if any
+    # index cannot be loaded, nothing is imported
+    fks = model.foreign_keys()
+    fk_indexes: Dict[ForeignKeySpecification, FkLabelIndex] = {}
+    failed = []
+
+    def on_index(fk_options: ForeignKeySpecification, index: FkLabelIndex) -> None:
+      fk_indexes[fk_options] = index
+      if len(fk_indexes) == len(fks) and len(failed) == 0:
+        self.showImportErrors(model.importRecords(records, fk_indexes))
+
+    def on_index_failed(e) -> None:
+      if len(failed) == 0:
+        self.setErrorLabel(f"Nothing imported: could not load the labels of {model.table_name} references: {e}")
+      failed.append(e)
+
+    if len(fks) == 0:
+      self.showImportErrors(model.importRecords(records, fk_indexes))
+    for fk_options in fks:
+      self.fk_options_cache.get_index(fk_options, lambda index, fk_options=fk_options: on_index(fk_options, index), on_index_failed)
+
+  def showImportErrors(self, errors: List[str]) -> None:
+    if len(errors) == 0:
+      return
+    self.setErrorLabel(f"Nothing imported: {len(errors)} problem(s) found")
+    report = QMessageBox(QMessageBox.Warning, "Import failed", f"Nothing was imported, {len(errors)} problem(s) found:\n\n" + "\n".join(errors[:20]), parent=self)
+    report.setDetailedText("\n".join(errors))
+    report.exec_()
+
   def setErrorLabel(self, e) -> None:
     logger.error(e)
     self.err_label.setText(f"<html><head/><body><p><span style=\"color:#ff0000;\">{e}</span></p></body></html>")
@@ -160,12 +309,18 @@ class MainWindow(QMainWindow, Ui_Interface):
     self.err_label.setText("")
     self.err_label.adjustSize()
 
+  def setBusy(self, busy: bool) -> None:
+    self.progress_bar.setVisible(busy)
+    self.cancel_btn.setVisible(busy)
+
 def main():
   QApplication.setStyle(QStyleFactory.create("fusion"))
   app = QApplication(sys.argv)
   main_window = MainWindow()
   main_window.show()
-  sys.exit(app.exec_())
+  exit_code = app.exec_()
+  main_window.db_pool.shutdown()
+  sys.exit(exit_code)
 
 
 if __name__ == '__main__':
@@ -1,87 +1,74 @@
-from flask import Flask, render_template
+from flask import Flask, Response, render_template, request, json
+from typing import Any, Callable, Hashable, Optional
+import click
+import gc
 import os
-from typing import Optional, List, Tuple
-import psycopg2
-from psycopg2.extensions import connection as pg_connection
-from textwrap import dedent
+import threading
+from cache import RevisionCache
+from datasource import DataSource, PostgresDataSource, create_data_source, export_snapshot
+from conflicts import ConflictReport, detect_conflicts
 
-connection: Optional[pg_connection] = None
 app = Flask(__name__)
+# Opened on first use, so commands like export-snapshot work before the configured source exists.
+# Shared by the threads of a worker (WEB_THREADS), which is why creating it takes a lock.
+_data_source: Optional[DataSource] = None
+_data_source_lock = threading.Lock()
 
 
-def connect_to_db() -> pg_connection:
-  global connection
-  if (connection is None):
-    connection = psycopg2.connect(host=os.getenv('DB_HOST', 'localhost'),
-                          database=os.getenv('DB_DATABASE', 'postgres'),
-                          user=os.getenv('APP_DB_USER', 'app'),
-                          password=os.getenv('APP_DB_PASSWORD'))
-  return connection
-  
+def get_data_source() -> DataSource:
+  global _data_source
+  if _data_source is None:
+    with _data_source_lock:
+      if _data_source is None:
+        _data_source = create_data_source()
+  return _data_source
 
-def close_db_connection() -> None:
-  global connection
-  if (connection is not None):
-    connection.close()
-    connection = None
 
-
-def query(query_str) -> List[Tuple]:
-  try:
-    conn = connect_to_db()
-    cur = conn.cursor()
-    cur.execute(query_str)
-    results = cur.fetchall()
-    cur.close()
-    return results
-  except Exception as e:
-    close_db_connection()
-    raise e
-
-
-def get_models():
-  return query('SELECT model_id, label, type_id, speed FROM model;')
+def close_data_source() -> None:
+  global _data_source
+  if _data_source is not None:
+    _data_source.close()
+    _data_source = None
 
 
-def get_vehicles():
-  return query('SELECT vehicle_id, label, model_id, owner_id FROM vehicle;')
-
+@app.cli.command('export-snapshot')
+@click.argument('path')
+def export_snapshot_command(path: str) -> None:
+  """Export the network from Postgres to a snapshot file for DATA_SOURCE=snapshot."""
+  source = PostgresDataSource()
+  try:
+    export_snapshot(source, path)
+  finally:
+    source.close()
 
-def get_hubs():
-  return query('SELECT hub_id, label, posX, posY FROM hub;')
 
+cache = RevisionCache()
 
-def get_paths():
-  return query('SELECT path_id, start_hub_id, end_hub_id FROM path;')
 
+def owner_arg() -> Optional[int]:
+  return request.args.get('owner_id', type=int)
 
-def get_movements():
-  return query('SELECT movement_id, ts, vehicle_id, path_id FROM movement;')
 
+def cached_json(key: Hashable, owner_id: Optional[int], build: Callable[[], Any]) -> Response:
+  # Serialized payloads are reused until the revision of the owner's data (all data when owner_id is None) changes
+  body = cache.get(key, get_data_source().get_revision(owner_id), lambda: json.dumps(build()))
+  return app.response_class(body, mimetype='application/json')
 
-def get_inconsistencies():
-  return query('SELECT movement_id, vehicle_id, ts, inconsistency_type FROM movement_inconsistencies;')
 
+def get_conflicts(owner_id: Optional[int] = None) -> ConflictReport:
+  # Capacity conflicts involve every owner sharing a path or hub, so reports depend on all owners'
+  # data; an owner's report only sweeps the paths and hubs its own vehicles use
+  source = get_data_source()
 
-def get_movements_with_arrival_info():
-  return query(dedent('''
-    SELECT 
-      m.ts, 
-      v.label, 
-      mdl.speed,
-      shub.posX AS startX, 
-      shub.posY AS startX, 
-      ehub.posX AS endX, 
-      ehub.posY AS endY, 
-      m.path_time,
-      v.vehicle_id
-    FROM movement_with_arrival m
-    JOIN vehicle v ON m.vehicle_id = v.vehicle_id
-    JOIN path p ON m.path_id = p.path_id
-    JOIN hub shub ON p.start_hub_id = shub.hub_id
-    JOIN hub ehub ON p.end_hub_id = ehub.hub_id
-    JOIN model mdl on v.model_id = mdl.model_id;
-  '''))
+  def build():
+    movements = source.get_movement_intervals(owner_id)
+    paths = hubs = None
+    if owner_id is not None:
+      owned = [m for m in movements if m[7] == owner_id]
+      paths = {m[4] for m in owned}
+      hubs = {hub for m in owned for hub in (m[5], m[6])}
+    return detect_conflicts(movements, dict(source.get_path_capacities()), dict(source.get_hub_capacities()), paths, hubs)
+  return cache.get(('conflicts', owner_id), source.get_revision(None), build)
 
 
 @app.route('/')
@@ -91,12 +78,16 @@ def index():
 
 @app.route('/api/movements')
 def movements():
-  return {
+  owner_id = owner_arg()
+  start = request.args.get('start', type=float)
+  end = request.args.get('end', type=float)
+  build = lambda: {
     "data": [
       {
         "timestamp": result[0], 
         "vehicle": result[1], 
         "vehicle_id": result[8], 
+        "movement_id": result[9],
         "speed": result[2], 
         "startPos": {
           "x": result[3], 
@@ -108,13 +99,32 @@ def movements():
         },
         "path_time": result[7],
       } 
-      for result in get_movements_with_arrival_info()
+      for result in get_data_source().get_movements_with_arrival_info(start, end, owner_id)
     ]
   }
+  # Playback windows start at arbitrary float times and are rarely requested twice, so only the
+  # full listing is cached; windows would just evict the shared payloads from the LRU
+  if start is None and end is None:
+    return cached_json(('movements', owner_id), owner_id, build)
+  return build()
+
+@app.route('/api/timeline')
+def timeline():
+  owner_id = owner_arg()
+
+  def build():
+    start, end = get_data_source().get_timeline(owner_id)
+    return {
+      "data": {
+        "start": start if start is not None else 0,
+        "end": end if end is not None else 0,
+      }
+    }
+  return cached_json(('timeline', owner_id), owner_id, build)
 
 @app.route('/api/hubs')
 def hubs():
-  return {
+  return cached_json(('hubs',), None, lambda: {
     "data": [
       {
         "hub_id": result[0],
@@ -124,12 +134,17 @@ def hubs():
           "y": result[3]
         }
       }
-      for result in get_hubs()
+      for result in get_data_source().get_hubs()
     ]
-  }
+  })
 
 @app.route('/api/inconsistencies')
 def inconsistencies():
+  owner_id = owner_arg()
+  source = get_data_source()
+  owner_rows = cache.get(('inconsistencies', owner_id), source.get_revision(owner_id), lambda: source.get_inconsistencies(owner_id))
+  report = get_conflicts(owner_id)
+  conflict_rows = report.inconsistencies if owner_id is None else report.owner_inconsistencies.get(owner_id, [])
   return {
     "data": [
       {
@@ -138,13 +153,55 @@ def inconsistencies():
         "timestamp": result[2],
         "inconsistency_type": result[3]
       }
-      for result in get_inconsistencies()
+      for result in owner_rows + conflict_rows
     ]
   }
 
+@app.route('/api/congestion')
+def congestion():
+  owner_id = owner_arg()
+  # An owner's report only holds peaks for the paths and hubs that owner uses
+  report = get_conflicts(owner_id)
+  paths = report.path_peaks.keys()
+  hubs = report.hub_peaks.keys()
+  return {
+    "data": {
+      "paths": [
+        {"path_id": path_id, "peak": report.path_peaks[path_id][0], "capacity": report.path_peaks[path_id][1]}
+        for path_id in sorted(paths)
+      ],
+      "hubs": [
+        {"hub_id": hub_id, "peak": report.hub_peaks[hub_id][0], "capacity": report.hub_peaks[hub_id][1]}
+        for hub_id in sorted(hubs)
+      ],
+    }
+  }
+
+
+def preload() -> None:
+  # Build the shared payloads before gunicorn forks its workers (preload_app), then release the
+  # connection so no worker inherits the master's socket
+  # Objects frozen by an earlier preload (on reload) are collectable again until the next freeze
+  gc.unfreeze()
+  close_data_source()
+  cache.clear()
+  try:
+    with app.test_request_context():
+      hubs()
+      timeline()
+      get_conflicts()
+  except Exception as e:
+    # The database may still be starting; workers then build the payloads on first request
+    app.logger.warning('Preload failed, payloads will be built on demand: %s', e)
+    cache.clear()
+  finally:
+    close_data_source()
+  # Keep the preloaded objects out of the collector so it does not touch (and copy) their pages
+  gc.freeze()
+
 
 if __name__ == "__main__":
   try:
-    app.run(debug=True)
+    app.run(debug=os.getenv('FLASK_DEBUG', '0') == '1')
   finally:
-    close_db_connection()
+    close_data_source()
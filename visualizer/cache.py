@@ -0,0 +1,32 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+
+class RevisionCache:
+  # LRU of payloads, each stored with the data revision it was built from. An entry is rebuilt when
+  # the revision passed in no longer matches, so invalidation follows whatever the revision tracks.
+  def __init__(self, max_entries: int = 512) -> None:
+    self.max_entries = max_entries
+    self._entries: OrderedDict = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key: Hashable, revision: Hashable, build: Callable[[], Any]) -> Any:
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry[0] == revision:
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    payload = build()
+
+    with self._lock:
+      self._entries[key] = (revision, payload)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+    return payload
+
+  def clear(self) -> None:
+    with self._lock:
+      self._entries.clear()
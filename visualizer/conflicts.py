@@ -0,0 +1,115 @@
+import math
+from collections import defaultdict
+from heapq import heappush, heappop
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+PATH_OVER_CAPACITY = 'PATH_OVER_CAPACITY'
+HUB_OVER_CAPACITY = 'HUB_OVER_CAPACITY'
+
+# (start, end, payload) half-open interval [start, end)
+Interval = Tuple[float, float, Any]
+
+
+class SweepResult:
+  def __init__(self, peak: int, over_capacity: List[Tuple[Interval, int]]) -> None:
+    self.peak = peak
+    # Intervals that started while the resource already held `capacity` others, with the
+    # intervals open at that moment (itself included)
+    self.over_capacity = over_capacity
+
+
+def sweep(intervals: List[Interval], capacity: Optional[int] = None) -> SweepResult:
+  # Sort by start, keep a min-heap of the intervals still open by end time: O(n log n), plus the
+  # open intervals listed for each over capacity start
+  open_intervals: List[Tuple[float, int, Interval]] = []
+  peak = 0
+  over_capacity = []
+  for n, interval in enumerate(sorted(intervals, key=lambda i: (i[0], i[1]))):
+    start, end, _ = interval
+    while len(open_intervals) > 0 and open_intervals[0][0] <= start:
+      heappop(open_intervals)
+    heappush(open_intervals, (end, n, interval))
+    concurrency = len(open_intervals)
+    peak = max(peak, concurrency)
+    if capacity is not None and concurrency > capacity:
+      over_capacity.append((interval, [i for _, _, i in open_intervals]))
+  return SweepResult(peak, over_capacity)
+
+
+class ConflictReport:
+  def __init__(self) -> None:
+    # (movement_id, vehicle_id, ts, inconsistency_type), same shape as movement_inconsistencies
+    self.inconsistencies: List[Tuple] = []
+    # {id: (peak concurrency, capacity)}
+    self.path_peaks: Dict[int, Tuple[int, Optional[int]]] = {}
+    self.hub_peaks: Dict[int, Tuple[int, Optional[int]]] = {}
+    # Per owner_id: the conflicts its vehicles are involved in, i.e. those where one of its
+    # vehicles occupies the resource when it goes over capacity
+    self.owner_inconsistencies: Dict[Optional[int], List[Tuple]] = defaultdict(list)
+
+  def add(self, movement: Tuple, ts: float, inconsistency_type: str, involved: List[Tuple]) -> None:
+    # movement tipped the resource over capacity; involved are the movements occupying it then
+    inconsistency = (movement[0], movement[1], ts, inconsistency_type)
+    self.inconsistencies.append(inconsistency)
+    for owner_id in {m[7] for m in involved}:
+      self.owner_inconsistencies[owner_id].append(inconsistency)
+
+
+def hub_intervals(movements: List[Tuple]) -> Dict[int, List[Interval]]:
+  # A vehicle occupies the end hub of each movement from its arrival until its next departure,
+  # its first start hub before its first departure, and its last end hub indefinitely
+  by_vehicle = defaultdict(list)
+  for movement in movements:
+    by_vehicle[movement[1]].append(movement)
+
+  intervals = defaultdict(list)
+  for vehicle_movements in by_vehicle.values():
+    vehicle_movements.sort(key=lambda m: m[2])
+    first = vehicle_movements[0]
+    intervals[first[5]].append((-math.inf, first[2], first))
+    for current, following in zip(vehicle_movements, vehicle_movements[1:]):
+      if current[3] < following[2]:
+        intervals[current[6]].append((current[3], following[2], current))
+    last = vehicle_movements[-1]
+    intervals[last[6]].append((last[3], math.inf, last))
+  return intervals
+
+
+def detect_conflicts(
+  movements: List[Tuple],
+  path_capacities: Dict[int, int],
+  hub_capacities: Dict[int, int],
+  paths: Optional[Set[int]] = None,
+  hubs: Optional[Set[int]] = None,
+) -> ConflictReport:
+  # movements: (movement_id, vehicle_id, ts, arrival_time, path_id, start_hub_id, end_hub_id, owner_id)
+  # Capacities missing from the dicts are unlimited; peak concurrency is still reported.
+  # paths/hubs restrict the sweep to those resources (all when None); movements must then include
+  # every movement of every vehicle passing through them.
+  report = ConflictReport()
+
+  path_intervals = defaultdict(list)
+  for movement in movements:
+    path_intervals[movement[4]].append((movement[2], movement[3], movement))
+
+  for path_id, intervals in path_intervals.items():
+    if paths is not None and path_id not in paths:
+      continue
+    capacity = path_capacities.get(path_id)
+    result = sweep(intervals, capacity)
+    report.path_peaks[path_id] = (result.peak, capacity)
+    for (_, _, movement), open_intervals in result.over_capacity:
+      report.add(movement, movement[2], PATH_OVER_CAPACITY, [i[2] for i in open_intervals])
+
+  for hub_id, intervals in hub_intervals(movements).items():
+    if hubs is not None and hub_id not in hubs:
+      continue
+    capacity = hub_capacities.get(hub_id)
+    result = sweep(intervals, capacity)
+    report.hub_peaks[hub_id] = (result.peak, capacity)
+    for (start, _, movement), open_intervals in result.over_capacity:
+      # Vehicles already parked before their first departure are reported at that departure
+      ts = start if math.isfinite(start) else movement[2]
+      report.add(movement, ts, HUB_OVER_CAPACITY, [i[2] for i in open_intervals])
+
+  return report
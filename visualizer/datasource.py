@@ -0,0 +1,396 @@
+import os
+import threading
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager, nullcontext
+from typing import ContextManager, Iterator, Optional, List, Tuple, Iterable
+import psycopg2
+from psycopg2.extensions import connection as pg_connection, ISOLATION_LEVEL_REPEATABLE_READ
+from textwrap import dedent
+from snapshot import Snapshot, write_snapshot, INT, FLOAT, STR
+
+MOVEMENT_COLUMNS = ['ts', 'label', 'speed', 'startX', 'startY', 'endX', 'endY', 'path_time', 'vehicle_id', 'movement_id']
+HUB_COLUMNS = ['hub_id', 'label', 'posX', 'posY']
+INCONSISTENCY_COLUMNS = ['movement_id', 'vehicle_id', 'ts', 'inconsistency_type']
+# Capacities and owners are nullable; the snapshot stores a missing value as this sentinel
+NO_CAPACITY = -1
+NO_OWNER = -1
+
+
+class DataSource():
+  def get_hubs(self) -> List[Tuple]:
+    raise Exception('not implemented')
+
+  # Only movements in progress at some point within [start, end) when a window is given, ordered by ts.
+  # owner_id restricts every owner-scoped method to the vehicles of that owner; None means all vehicles.
+  def get_movements_with_arrival_info(self, start: Optional[float] = None, end: Optional[float] = None, owner_id: Optional[int] = None) -> List[Tuple]:
+    raise Exception('not implemented')
+
+  def get_inconsistencies(self, owner_id: Optional[int] = None) -> List[Tuple]:
+    raise Exception('not implemented')
+
+  def get_timeline(self, owner_id: Optional[int] = None) -> Tuple:
+    raise Exception('not implemented')
+
+  # (movement_id, vehicle_id, ts, arrival_time, path_id, start_hub_id, end_hub_id, owner_id)
+  # With an owner_id: every movement, of any owner, of the vehicles that pass through a hub the
+  # owner's vehicles pass through, which covers all occupancy of the owner's paths and hubs
+  def get_movement_intervals(self, owner_id: Optional[int] = None) -> List[Tuple]:
+    raise Exception('not implemented')
+
+  # (path_id, capacity) for paths with a capacity limit
+  def get_path_capacities(self) -> List[Tuple]:
+    raise Exception('not implemented')
+
+  # (hub_id, capacity) for hubs with a capacity limit
+  def get_hub_capacities(self) -> List[Tuple]:
+    raise Exception('not implemented')
+
+  # Changes whenever data visible to owner_id (all owners when None) may have changed
+  def get_revision(self, owner_id: Optional[int] = None) -> int:
+    raise Exception('not implemented')
+
+  # Reads made within the context see one consistent state of the data
+  def consistent_reads(self) -> ContextManager:
+    return nullcontext()
+
+  def close(self) -> None:
+    pass
+
+
+class PostgresDataSource(DataSource):
+  def __init__(self) -> None:
+    # One connection per thread (gunicorn's gthread workers share the data source), all tracked
+    # so close() can release them
+    self._local = threading.local()
+    self._connections: List[pg_connection] = []
+    self._connections_lock = threading.Lock()
+
+  def connect_to_db(self) -> pg_connection:
+    connection = getattr(self._local, 'connection', None)
+    if (connection is None):
+      connection = psycopg2.connect(host=os.getenv('DB_HOST', 'localhost'),
+                                    database=os.getenv('DB_DATABASE', 'postgres'),
+                                    user=os.getenv('APP_DB_USER', 'app'),
+                                    password=os.getenv('APP_DB_PASSWORD'))
+      # Every statement is its own transaction, so idle workers hold no locks that would block DDL
+      # such as db/migrate.sql or the editor's schema updates
+      connection.set_session(readonly=True, autocommit=True)
+      self._local.connection = connection
+      with self._connections_lock:
+        self._connections.append(connection)
+    return connection
+
+  def _close_thread_connection(self) -> None:
+    connection = getattr(self._local, 'connection', None)
+    if (connection is not None):
+      with self._connections_lock:
+        self._connections.remove(connection)
+      connection.close()
+      self._local.connection = None
+
+  def close(self) -> None:
+    # Only while no other thread is querying, e.g. before forking or at shutdown
+    with self._connections_lock:
+      for connection in self._connections:
+        connection.close()
+      self._connections.clear()
+    self._local = threading.local()
+
+  @contextmanager
+  def consistent_reads(self) -> Iterator[None]:
+    # One REPEATABLE READ transaction instead of a transaction per statement
+    connection = self.connect_to_db()
+    connection.set_session(isolation_level=ISOLATION_LEVEL_REPEATABLE_READ, autocommit=False)
+    try:
+      yield
+    finally:
+      # A failed query closes the connection, which ends the transaction as well
+      if not connection.closed:
+        connection.rollback()
+        connection.set_session(isolation_level='DEFAULT', autocommit=True)
+
+  def query(self, query_str, params: Iterable = []) -> List[Tuple]:
+    try:
+      conn = self.connect_to_db()
+      cur = conn.cursor()
+      cur.execute(query_str, params)
+      results = cur.fetchall()
+      cur.close()
+      return results
+    except Exception as e:
+      # The connection may be broken; the next query of this thread reconnects
+      self._close_thread_connection()
+      raise e
+
+  def get_hubs(self) -> List[Tuple]:
+    return self.query('SELECT hub_id, label, posX, posY FROM hub;')
+
+  def get_inconsistencies(self, owner_id: Optional[int] = None) -> List[Tuple]:
+    return self.query('SELECT movement_id, vehicle_id, ts, inconsistency_type FROM owner_movement_inconsistencies(%s);', [owner_id])
+
+  def get_timeline(self, owner_id: Optional[int] = None) -> Tuple:
+    if owner_id is None:
+      return self.query('SELECT MIN(ts), MAX(arrival_time) FROM movement_with_arrival;')[0]
+    return self.query(dedent('''
+      SELECT MIN(m.ts), MAX(m.arrival_time)
+      FROM movement_with_arrival m
+      JOIN vehicle v ON m.vehicle_id = v.vehicle_id
+      WHERE v.owner_id = %s;
+    '''), [owner_id])[0]
+
+  def get_movement_intervals(self, owner_id: Optional[int] = None) -> List[Tuple]:
+    select = dedent('''
+      SELECT m.movement_id, m.vehicle_id, m.ts, m.arrival_time, m.path_id, p.start_hub_id, p.end_hub_id, v.owner_id
+      FROM movement_with_arrival m
+      JOIN path p ON m.path_id = p.path_id
+      JOIN vehicle v ON m.vehicle_id = v.vehicle_id
+    ''')
+    if owner_id is None:
+      return self.query(select + ';')
+    return self.query(dedent('''
+      WITH owner_path AS (
+        SELECT DISTINCT m.path_id
+        FROM movement m
+        JOIN vehicle v ON m.vehicle_id = v.vehicle_id
+        WHERE v.owner_id = %s
+      ), owner_hub AS (
+        SELECT start_hub_id AS hub_id FROM path JOIN owner_path USING (path_id)
+        UNION
+        SELECT end_hub_id FROM path JOIN owner_path USING (path_id)
+      ), shared_vehicle AS (
+        SELECT DISTINCT m.vehicle_id
+        FROM movement m
+        JOIN path p ON m.path_id = p.path_id
+        WHERE p.start_hub_id IN (SELECT hub_id FROM owner_hub) OR p.end_hub_id IN (SELECT hub_id FROM owner_hub)
+      )
+    ''') + select + 'WHERE m.vehicle_id IN (SELECT vehicle_id FROM shared_vehicle);', [owner_id])
+
+  def get_path_capacities(self) -> List[Tuple]:
+    return self.query('SELECT path_id, capacity FROM path WHERE capacity IS NOT NULL;')
+
+  def get_hub_capacities(self) -> List[Tuple]:
+    return self.query('SELECT hub_id, capacity FROM hub WHERE capacity IS NOT NULL;')
+
+  def get_revision(self, owner_id: Optional[int] = None) -> int:
+    # Revisions only ever increase, so their sum changes whenever any owner's does
+    if owner_id is None:
+      return self.query('SELECT COALESCE(SUM(revision), 0) FROM owner_revision;')[0][0]
+    return self.query('SELECT COALESCE(MAX(revision), 0) FROM owner_revision WHERE owner_id = %s;', [owner_id])[0][0]
+
+  def get_movements_with_arrival_info(self, start: Optional[float] = None, end: Optional[float] = None, owner_id: Optional[int] = None) -> List[Tuple]:
+    where = []
+    params = []
+    if start is not None:
+      # arrival_time is computed, so bound ts as well: no movement takes longer than the longest
+      # path at the slowest speed. ts is compared as BIGINT so movement_timestamp_idx applies.
+      where.append('m.arrival_time > %s')
+      where.append(
+        'm.ts >= COALESCE((SELECT FLOOR(%s - MAX(dist(s.posX, s.posY, e.posX, e.posY)) / NULLIF((SELECT MIN(speed) FROM model WHERE speed > 0), 0))'
+        ' FROM path JOIN hub s ON path.start_hub_id = s.hub_id JOIN hub e ON path.end_hub_id = e.hub_id)::BIGINT, %s)')
+      params += [start, start, -2 ** 63]
+    if end is not None:
+      where.append('m.ts < CEIL(%s)::BIGINT')
+      params.append(end)
+    if owner_id is not None:
+      where.append('v.owner_id = %s')
+      params.append(owner_id)
+    return self.query(dedent(f'''
+      SELECT
+        m.ts,
+        v.label,
+        mdl.speed,
+        shub.posX AS startX,
+        shub.posY AS startX,
+        ehub.posX AS endX,
+        ehub.posY AS endY,
+        m.path_time,
+        v.vehicle_id,
+        m.movement_id
+      FROM movement_with_arrival m
+      JOIN vehicle v ON m.vehicle_id = v.vehicle_id
+      JOIN path p ON m.path_id = p.path_id
+      JOIN hub shub ON p.start_hub_id = shub.hub_id
+      JOIN hub ehub ON p.end_hub_id = ehub.hub_id
+      JOIN model mdl on v.model_id = mdl.model_id
+      {"WHERE " + " AND ".join(where) if where else ""}
+      ORDER BY m.ts, m.movement_id;
+    '''), params)
+
+
+class SnapshotDataSource(DataSource):
+  def __init__(self, path: str) -> None:
+    self.snapshot = Snapshot(path)
+    self._hubs = self.snapshot['hub']
+    self._paths = self.snapshot['path']
+    # Movements and inconsistencies are sorted by owner, and movements by ts within an owner, so an
+    # owner's rows are one contiguous slice listed in the owner table
+    self._movements = self.snapshot['movement']
+    self._inconsistencies = self.snapshot['inconsistency']
+    owners = self.snapshot['owner']
+    # Vehicles without an owner are stored under NO_OWNER, which is not an owner_id to look up
+    self._owners = {owners['owner_id'][i]: i for i in range(len(owners)) if owners['owner_id'][i] != NO_OWNER}
+    self._owner_table = owners
+    # Upper bound on how long before a window starts a movement overlapping it may have departed
+    self._max_path_time = self.snapshot.meta['max_path_time']
+
+  def _owner_slices(self, owner_id: Optional[int], start_column: str, stop_column: str) -> List[Tuple[int, int]]:
+    if owner_id is None:
+      rows = range(len(self._owner_table))
+    elif owner_id in self._owners:
+      rows = [self._owners[owner_id]]
+    else:
+      rows = []
+    return [(self._owner_table[start_column][i], self._owner_table[stop_column][i]) for i in rows]
+
+  def get_hubs(self) -> List[Tuple]:
+    return [self._hubs.row(i, HUB_COLUMNS) for i in range(len(self._hubs))]
+
+  def get_inconsistencies(self, owner_id: Optional[int] = None) -> List[Tuple]:
+    return [
+      self._inconsistencies.row(i, INCONSISTENCY_COLUMNS)
+      for lo, hi in self._owner_slices(owner_id, 'inconsistency_start', 'inconsistency_stop')
+      for i in range(lo, hi)
+    ]
+
+  def get_timeline(self, owner_id: Optional[int] = None) -> Tuple:
+    if owner_id is None:
+      return self.snapshot.meta['timeline_start'], self.snapshot.meta['timeline_end']
+    if owner_id not in self._owners:
+      return None, None
+    i = self._owners[owner_id]
+    return self._owner_table['timeline_start'][i], self._owner_table['timeline_end'][i]
+
+  def get_movement_intervals(self, owner_id: Optional[int] = None) -> List[Tuple]:
+    movement_id, vehicle_id, ts, path_time = [self._movements[c] for c in ['movement_id', 'vehicle_id', 'ts', 'path_time']]
+    path_id, start_hub_id, end_hub_id, owner = [self._movements[c] for c in ['path_id', 'start_hub_id', 'end_hub_id', 'owner_id']]
+    rows = range(len(self._movements))
+    if owner_id is not None:
+      hubs = {hub for lo, hi in self._owner_slices(owner_id, 'movement_start', 'movement_stop') for i in range(lo, hi) for hub in (start_hub_id[i], end_hub_id[i])}
+      vehicles = {vehicle_id[i] for i in rows if start_hub_id[i] in hubs or end_hub_id[i] in hubs}
+      rows = [i for i in rows if vehicle_id[i] in vehicles]
+    return [
+      (movement_id[i], vehicle_id[i], ts[i], ts[i] + path_time[i], path_id[i], start_hub_id[i], end_hub_id[i], None if owner[i] == NO_OWNER else owner[i])
+      for i in rows
+    ]
+
+  def _capacities(self, table, id_column: str) -> List[Tuple]:
+    ids = table[id_column]
+    capacity = table['capacity']
+    return [(ids[i], capacity[i]) for i in range(len(table)) if capacity[i] != NO_CAPACITY]
+
+  def get_path_capacities(self) -> List[Tuple]:
+    return self._capacities(self._paths, 'path_id')
+
+  def get_hub_capacities(self) -> List[Tuple]:
+    return self._capacities(self._hubs, 'hub_id')
+
+  def get_revision(self, owner_id: Optional[int] = None) -> int:
+    # Snapshots are immutable
+    return 0
+
+  def get_movements_with_arrival_info(self, start: Optional[float] = None, end: Optional[float] = None, owner_id: Optional[int] = None) -> List[Tuple]:
+    ts = self._movements['ts']
+    path_time = self._movements['path_time']
+    rows = []
+    slices = self._owner_slices(owner_id, 'movement_start', 'movement_stop')
+    for owner_lo, owner_hi in slices:
+      lo = owner_lo if start is None else bisect_left(ts, start - self._max_path_time, owner_lo, owner_hi)
+      hi = owner_hi if end is None else bisect_left(ts, end, owner_lo, owner_hi)
+      rows += [
+        self._movements.row(i, MOVEMENT_COLUMNS)
+        for i in range(lo, hi)
+        if start is None or ts[i] + path_time[i] > start
+      ]
+    if len(slices) > 1:
+      rows.sort(key=lambda row: (row[0], row[9]))
+    return rows
+
+
+def export_snapshot(source: DataSource, path: str) -> None:
+  with source.consistent_reads():
+    _export_snapshot(source, path)
+
+
+def _export_snapshot(source: DataSource, path: str) -> None:
+  hubs = source.get_hubs()
+  intervals = {row[0]: row for row in source.get_movement_intervals()}
+  vehicle_owners = {row[1]: row[7] for row in intervals.values()}
+
+  def owner_key(owner_id: Optional[int]) -> int:
+    return NO_OWNER if owner_id is None else owner_id
+
+  movements = source.get_movements_with_arrival_info()
+  movements.sort(key=lambda row: (owner_key(intervals[row[9]][7]), row[0], row[9]))
+  inconsistencies = source.get_inconsistencies()
+  inconsistencies.sort(key=lambda row: (owner_key(vehicle_owners.get(row[1])), row[2], row[0]))
+  timeline_start, timeline_end = source.get_timeline()
+  path_capacities = dict(source.get_path_capacities())
+  hub_capacities = dict(source.get_hub_capacities())
+  path_ids = sorted(set([row[4] for row in intervals.values()]) | set(path_capacities.keys()))
+
+  def column(rows: List[Tuple], index: int) -> List:
+    return [row[index] for row in rows]
+
+  def interval_column(index: int) -> List:
+    return [intervals[row[9]][index] for row in movements]
+
+  movement_owners = [owner_key(owner_id) for owner_id in interval_column(7)]
+  inconsistency_owners = [owner_key(vehicle_owners.get(row[1])) for row in inconsistencies]
+  owner_ids = sorted(set(movement_owners))
+
+  def owner_range(keys: List[int], owner_id: int) -> Tuple[int, int]:
+    return bisect_left(keys, owner_id), bisect_right(keys, owner_id)
+
+  owner_movements = [owner_range(movement_owners, owner_id) for owner_id in owner_ids]
+  owner_inconsistencies = [owner_range(inconsistency_owners, owner_id) for owner_id in owner_ids]
+
+  write_snapshot(path, {
+    'hub': [
+      ('hub_id', INT, column(hubs, 0)),
+      ('label', STR, column(hubs, 1)),
+      ('posX', FLOAT, column(hubs, 2)),
+      ('posY', FLOAT, column(hubs, 3)),
+      ('capacity', INT, [hub_capacities.get(row[0], NO_CAPACITY) for row in hubs]),
+    ],
+    'path': [
+      ('path_id', INT, path_ids),
+      ('capacity', INT, [path_capacities.get(path_id, NO_CAPACITY) for path_id in path_ids]),
+    ],
+    'movement': [
+      (name, column_type, column(movements, i))
+      for i, (name, column_type) in enumerate(zip(MOVEMENT_COLUMNS, [INT, STR, FLOAT, FLOAT, FLOAT, FLOAT, FLOAT, FLOAT, INT, INT]))
+    ] + [
+      ('path_id', INT, interval_column(4)),
+      ('start_hub_id', INT, interval_column(5)),
+      ('end_hub_id', INT, interval_column(6)),
+      ('owner_id', INT, movement_owners),
+    ],
+    'inconsistency': [
+      ('movement_id', INT, column(inconsistencies, 0)),
+      ('vehicle_id', INT, column(inconsistencies, 1)),
+      ('ts', INT, column(inconsistencies, 2)),
+      ('inconsistency_type', STR, column(inconsistencies, 3)),
+    ],
+    'owner': [
+      ('owner_id', INT, owner_ids),
+      ('movement_start', INT, column(owner_movements, 0)),
+      ('movement_stop', INT, column(owner_movements, 1)),
+      ('inconsistency_start', INT, column(owner_inconsistencies, 0)),
+      ('inconsistency_stop', INT, column(owner_inconsistencies, 1)),
+      ('timeline_start', FLOAT, [min(column(movements[lo:hi], 0)) for lo, hi in owner_movements]),
+      ('timeline_end', FLOAT, [max(row[0] + row[7] for row in movements[lo:hi]) for lo, hi in owner_movements]),
+    ],
+  }, meta={
+    'max_path_time': max(column(movements, 7), default=0),
+    'timeline_start': timeline_start,
+    'timeline_end': timeline_end,
+  })
+
+
+def create_data_source() -> DataSource:
+  kind = os.getenv('DATA_SOURCE', 'postgres')
+  if kind == 'postgres':
+    return PostgresDataSource()
+  elif kind == 'snapshot':
+    return SnapshotDataSource(os.getenv('SNAPSHOT_PATH', 'snapshot.bin'))
+  raise Exception(f'Unknown DATA_SOURCE: {kind}')
@@ -0,0 +1,32 @@
+# Production serving: gunicorn -c gunicorn.conf.py app:app
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('WEB_THREADS', '1'))
+worker_class = 'gthread' if threads > 1 else 'sync'
+timeout = int(os.getenv('WEB_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests // 10
+
+# Import the app, and with it the hub graph and other reference data, once in the master so that
+# workers share those pages copy-on-write instead of each loading its own copy
+preload_app = True
+
+accesslog = os.getenv('WEB_ACCESS_LOG', None)
+errorlog = '-'
+
+
+def when_ready(server):
+  import app
+  app.preload()
+
+
+def on_reload(server):
+  # SIGHUP: refresh reference data (and reopen the snapshot file) in the master before the new
+  # workers are forked; old workers finish their in-flight requests within graceful_timeout
+  import app
+  app.preload()
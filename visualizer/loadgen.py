@@ -0,0 +1,91 @@
+# Local load generator: reports throughput and p50/p99 latency per endpoint
+#   python loadgen.py --url http://localhost:5000 --concurrency 16 --duration 30
+import argparse
+import http.client
+import math
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
+
+DEFAULT_ENDPOINTS = [
+  '/api/hubs',
+  '/api/timeline',
+  '/api/movements?start=0&end=60',
+  '/api/inconsistencies',
+  '/api/congestion',
+]
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+  if len(sorted_values) == 0:
+    return float('nan')
+  return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def run_client(base_url: str, endpoints: List[str], deadline: float, offset: int, results: Dict[str, List[Tuple[float, bool]]], lock: threading.Lock) -> None:
+  url = urlsplit(base_url)
+  connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+  local = defaultdict(list)
+  i = offset
+  while time.monotonic() < deadline:
+    endpoint = endpoints[i % len(endpoints)]
+    i += 1
+    start = time.perf_counter()
+    try:
+      connection.request('GET', url.path.rstrip('/') + endpoint)
+      response = connection.getresponse()
+      response.read()
+      ok = response.status == 200
+    except (OSError, http.client.HTTPException):
+      ok = False
+      connection.close()
+      connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=30)
+    local[endpoint].append((time.perf_counter() - start, ok))
+  connection.close()
+  with lock:
+    for endpoint, samples in local.items():
+      results[endpoint].extend(samples)
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--url', default='http://localhost:5000')
+  parser.add_argument('--concurrency', type=int, default=8, help='number of concurrent keep-alive clients')
+  parser.add_argument('--duration', type=float, default=10, help='seconds to run')
+  parser.add_argument('--owner-id', type=int, default=None, help='add owner_id to every request')
+  parser.add_argument('endpoints', nargs='*', default=DEFAULT_ENDPOINTS)
+  options = parser.parse_args()
+
+  endpoints = options.endpoints
+  if options.owner_id is not None:
+    endpoints = [e + ('&' if '?' in e else '?') + f'owner_id={options.owner_id}' for e in endpoints]
+
+  results: Dict[str, List[Tuple[float, bool]]] = defaultdict(list)
+  lock = threading.Lock()
+  deadline = time.monotonic() + options.duration
+  clients = [
+    threading.Thread(target=run_client, args=(options.url, endpoints, deadline, i, results, lock))
+    for i in range(options.concurrency)
+  ]
+  started = time.monotonic()
+  for client in clients:
+    client.start()
+  for client in clients:
+    client.join()
+  elapsed = time.monotonic() - started
+
+  print(f"{'endpoint':<50} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+  total = 0
+  for endpoint in endpoints:
+    samples = results[endpoint]
+    latencies = sorted([latency for latency, _ in samples])
+    errors = len([ok for _, ok in samples if not ok])
+    total += len(samples)
+    print(f"{endpoint:<50} {len(samples):>9} {errors:>7} {len(samples) / elapsed:>9.1f} {percentile(latencies, 50) * 1000:>9.2f} {percentile(latencies, 99) * 1000:>9.2f}")
+  print(f"{'total':<50} {total:>9} {'':>7} {total / elapsed:>9.1f}")
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,145 @@
+import json
+import mmap
+import os
+import struct
+from array import array
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+# File layout:
+#   MAGIC | u64 header length | JSON header | column buffers (each 8-byte aligned)
+# The header lists every table's row count and, per column, its type and the byte ranges of its
+# buffers. Numeric columns are stored as raw native-endian arrays that the reader exposes as
+# memoryviews straight over the mapping, so nothing is copied and every process that maps the
+# same file shares the same page cache pages.
+MAGIC = b'TSIMSNP1'
+ALIGNMENT = 8
+
+INT = 'q'
+FLOAT = 'd'
+STR = 'str'
+
+Column = Tuple[str, str, Sequence[Any]]  # (name, type, values)
+
+
+class StrColumn:
+  def __init__(self, offsets: memoryview, data: memoryview, nulls: Optional[memoryview]) -> None:
+    self._offsets = offsets
+    self._data = data
+    self._nulls = nulls
+
+  def __len__(self) -> int:
+    return len(self._offsets) - 1
+
+  def __getitem__(self, i: int) -> Optional[str]:
+    if self._nulls is not None and self._nulls[i]:
+      return None
+    return str(self._data[self._offsets[i] : self._offsets[i + 1]], 'utf-8')
+
+
+SnapshotColumn = Union[memoryview, StrColumn]
+
+
+class SnapshotTable:
+  def __init__(self, rows: int, columns: Dict[str, SnapshotColumn]) -> None:
+    self.rows = rows
+    self.columns = columns
+
+  def __len__(self) -> int:
+    return self.rows
+
+  def __getitem__(self, name: str) -> SnapshotColumn:
+    return self.columns[name]
+
+  def row(self, i: int, names: Sequence[str]) -> Tuple:
+    return tuple(self.columns[name][i] for name in names)
+
+
+class _Writer:
+  def __init__(self) -> None:
+    self.buffers: List[bytes] = []
+    self.offset = 0
+
+  def add(self, buffer: bytes) -> Dict[str, int]:
+    location = {'offset': self.offset, 'length': len(buffer)}
+    padding = -len(buffer) % ALIGNMENT
+    self.buffers.append(buffer + b'\0' * padding)
+    self.offset += len(buffer) + padding
+    return location
+
+
+def write_snapshot(path: str, tables: Dict[str, List[Column]], meta: Dict[str, Any] = {}) -> None:
+  writer = _Writer()
+  header = {'meta': meta, 'tables': {}}
+  for table_name, columns in tables.items():
+    rows = len(columns[0][2]) if len(columns) > 0 else 0
+    table_header = {'rows': rows, 'columns': {}}
+    for name, column_type, values in columns:
+      if len(values) != rows:
+        raise ValueError(f'Column {table_name}.{name} has {len(values)} rows, expected {rows}')
+      if column_type == STR:
+        encoded = [b'' if v is None else str(v).encode('utf-8') for v in values]
+        offsets = array(INT, [0])
+        for e in encoded:
+          offsets.append(offsets[-1] + len(e))
+        column_header = {
+          'type': STR,
+          'offsets': writer.add(offsets.tobytes()),
+          'data': writer.add(b''.join(encoded)),
+        }
+        if any(v is None for v in values):
+          column_header['nulls'] = writer.add(bytes([v is None for v in values]))
+      elif column_type == FLOAT:
+        column_header = {'type': FLOAT, 'data': writer.add(array(FLOAT, [float('nan') if v is None else v for v in values]).tobytes())}
+      elif column_type == INT:
+        column_header = {'type': INT, 'data': writer.add(array(INT, values).tobytes())}
+      else:
+        raise ValueError(f'Unknown column type {column_type} for {table_name}.{name}')
+      table_header['columns'][name] = column_header
+    header['tables'][table_name] = table_header
+
+  header_bytes = json.dumps(header).encode('utf-8')
+  header_bytes += b' ' * (-(len(MAGIC) + 8 + len(header_bytes)) % ALIGNMENT)
+
+  # Write next to the destination and rename, so processes that still map the old file keep a
+  # consistent view until they reopen it
+  tmp_path = f'{path}.tmp'
+  with open(tmp_path, 'wb') as f:
+    f.write(MAGIC)
+    f.write(struct.pack('<Q', len(header_bytes)))
+    f.write(header_bytes)
+    for buffer in writer.buffers:
+      f.write(buffer)
+  os.replace(tmp_path, path)
+
+
+class Snapshot:
+  def __init__(self, path: str) -> None:
+    with open(path, 'rb') as f:
+      self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self._view = memoryview(self._mmap)
+    if self._view[:len(MAGIC)] != MAGIC:
+      raise ValueError(f'{path} is not a snapshot file')
+    (header_length,) = struct.unpack_from('<Q', self._mmap, len(MAGIC))
+    header_start = len(MAGIC) + 8
+    header = json.loads(self._view[header_start : header_start + header_length].tobytes())
+    self._data_start = header_start + header_length
+    self.meta: Dict[str, Any] = header['meta']
+    self.tables: Dict[str, SnapshotTable] = {
+      name: SnapshotTable(table['rows'], {
+        column_name: self._column(column) for column_name, column in table['columns'].items()
+      })
+      for name, table in header['tables'].items()
+    }
+
+  def _buffer(self, location: Dict[str, int]) -> memoryview:
+    start = self._data_start + location['offset']
+    return self._view[start : start + location['length']]
+
+  def _column(self, column: Dict[str, Any]) -> SnapshotColumn:
+    if column['type'] == STR:
+      nulls = self._buffer(column['nulls']) if 'nulls' in column else None
+      return StrColumn(self._buffer(column['offsets']).cast(INT), self._buffer(column['data']), nulls)
+    return self._buffer(column['data']).cast(column['type'])
+
+  def __getitem__(self, name: str) -> SnapshotTable:
+    return self.tables[name]
@@ -5,6 +5,18 @@ function round(num) {
   return Math.round((num + Number.EPSILON) * 100) / 100;
 }
 
+// Dashboards opened with ?owner_id=N only request that owner's fleet
+const OWNER_ID = new URLSearchParams(window.location.search).get("owner_id");
+
+function apiUrl(path, params = {}) {
+  const query = new URLSearchParams(params);
+  if (OWNER_ID !== null) {
+    query.set("owner_id", OWNER_ID);
+  }
+  const queryString = query.toString();
+  return queryString ? path + "?" + queryString : path;
+}
+
 // ----------------------------------------------------------------------------
 //                                   DOM
 // ----------------------------------------------------------------------------
@@ -12,6 +24,10 @@ const canvas = d3.select("#canvas");
 const vehiclesGroup = canvas.append("g").attr("id", "vehicles");
 const hubsGroup = canvas.append("g").attr("id", "hubs");
 const resetBtn = d3.select("#reset_btn");
+const playBtn = d3.select("#play_btn");
+const speedSelect = d3.select("#speed_select");
+const seekSlider = d3.select("#seek_slider");
+const timeLabel = d3.select("#time_label");
 const inconsistencies = d3.select("#inconsistencies")
 
 const tooltip = d3.select("body")
@@ -100,88 +116,211 @@ function handleHubsData(data) {
       .on("mouseout", (event) => tooltip.style("visibility", "hidden"));
 }
 
-function handleMovData(data) {
-  // Color vehicles based on their vehicle_id
-  const colorRange = d3.scaleOrdinal()
-    .domain(d3.extent(data.map(d => d.vehicle_id)))
-    .range(d3.schemeSet3);
-
-  // Cancel any pending transitions
-  vehiclesGroup.selectAll(".vehicle").interrupt();
-  vehiclesGroup.selectAll(".vehicle_label").interrupt();
-
-  vehiclesGroup.selectAll(".vehicle").data(data)
-    .join(
-      enter => {
-        const root = enter.append("g").classed("vehicle", true);
-        root.append("circle")
-          .attr("r", VEHICLE_RADIUS - 1)
-          .style("stroke", "black")
-          .style("stroke-width", 1)
-          .style("fill", (d) => colorRange(d.vehicle_id));
-        root.append("text")
-          .classed("vehicle_label", true)
-          .attr("dx", "6px")
-          .style("font-size", "10px")
-          .text((d) => d.vehicle)
-          .style("opacity", 0)
-          .transition()
-            .duration(d => d.path_time * 1000 / 2)
-            .ease(d3.easeExpOut)
-            .delay(d => d.timestamp * 1000)
-            .style("opacity", 1)
-          .transition()
-            .duration(d => d.path_time * 1000 / 2)
-            .ease(d3.easeExpIn)
-            .style("opacity", 0)
-        return root;
-      },
-      update => {
-        update.select("circle")
-          .style("fill", (d) => colorRange(d.vehicle_id));
-        update.select("text")
-          .text((d) => d.vehicle)
-          .style("opacity", 0)
-          .transition()
-            .duration(d => d.path_time * 1000 / 2)
-            .ease(d3.easeExpOut)
-            .delay(d => d.timestamp * 1000)
-            .style("opacity", 1)
-          .transition()
-            .duration(d => d.path_time * 1000 / 2)
-            .ease(d3.easeExpIn)
-            .style("opacity", 0)
-        return update;
+// ----------------------------------------------------------------------------
+//                                 PLAYBACK
+// ----------------------------------------------------------------------------
+
+// Simulation seconds of movements requested per fetch and how far ahead of the
+// cursor the next window is requested.
+const FETCH_WINDOW = 60;
+const FETCH_LOOKAHEAD = 20;
+// Wall clock milliseconds before a failed window is requested again, doubled
+// after every consecutive failure.
+const RETRY_DELAY = 1000;
+const MAX_RETRY_DELAY = 30000;
+
+const colorRange = d3.scaleOrdinal().range(d3.schemeSet3);
+
+const playback = {
+  cursor: 0,            // current simulation time in seconds
+  speed: 1,             // simulation seconds per wall clock second
+  playing: false,
+  timeline: { start: 0, end: 0 },
+  buffered: new Map(),  // movement_id -> movement, fetched and not yet finished
+  fetchedUntil: 0,      // end of the last requested window
+  fetching: false,
+  failures: 0,          // consecutive failed fetches
+  retryAt: 0,           // performance.now() before which no window is requested
+  generation: 0,        // bumped on seek so stale window responses are dropped
+  lastFrame: null,
+};
+
+function fetchWindow(start, end) {
+  const generation = playback.generation;
+  playback.fetching = true;
+  playback.fetchedUntil = end;
+  return fetch(apiUrl('/api/movements', { start: start, end: end }))
+    .then(data => {
+      if (!data.ok) {
+        throw new Error(data.statusText);
+      }
+      return data.json();
+    })
+    .then(movRes => {
+      if (generation !== playback.generation) {
+        return;
       }
-    )
-      .attr("transform", (d) => "translate(" + widthTransform(d.startPos.x) + "," + heightTransform(d.startPos.y) + ")")
-      .transition()
-        .duration(d => d.path_time * 1000)
-        .ease(d3.easeLinear)
-        .delay(d => d.timestamp * 1000)
-        .attr("transform", (d) => "translate(" + widthTransform(d.endPos.x) + "," + heightTransform(d.endPos.y) + ")");
+      playback.failures = 0;
+      for (const mov of movRes.data) {
+        playback.buffered.set(mov.movement_id, mov);
+      }
+    })
+    .catch(() => {
+      // Request the same window again once the backoff has passed
+      if (generation === playback.generation) {
+        playback.fetchedUntil = start;
+        playback.retryAt = performance.now() + Math.min(RETRY_DELAY * 2 ** playback.failures, MAX_RETRY_DELAY);
+        playback.failures += 1;
+      }
+    })
+    .finally(() => {
+      if (generation === playback.generation) {
+        playback.fetching = false;
+      }
+    });
+}
+
+function ensureBuffered() {
+  if (playback.fetching || playback.fetchedUntil >= playback.timeline.end || performance.now() < playback.retryAt) {
+    return;
+  }
+  if (playback.cursor + FETCH_LOOKAHEAD >= playback.fetchedUntil) {
+    const start = Math.max(playback.fetchedUntil, playback.cursor);
+    fetchWindow(start, start + FETCH_WINDOW);
+  }
+}
+
+function evictFinished() {
+  for (const [id, mov] of playback.buffered) {
+    if (mov.timestamp + mov.path_time <= playback.cursor) {
+      playback.buffered.delete(id);
+    }
+  }
+}
+
+function activeMovements() {
+  const active = [];
+  for (const mov of playback.buffered.values()) {
+    if (mov.timestamp <= playback.cursor && playback.cursor < mov.timestamp + mov.path_time) {
+      active.push(mov);
+    }
+  }
+  return active;
 }
 
+function vehiclePosition(d) {
+  const progress = (playback.cursor - d.timestamp) / d.path_time;
+  const x = d.startPos.x + (d.endPos.x - d.startPos.x) * progress;
+  const y = d.startPos.y + (d.endPos.y - d.startPos.y) * progress;
+  return "translate(" + widthTransform(x) + "," + heightTransform(y) + ")";
+}
+
+function labelOpacity(d) {
+  // Fade the label in over the first half of the movement and out over the second
+  const progress = (playback.cursor - d.timestamp) / d.path_time;
+  if (progress < 0.5) {
+    return d3.easeExpOut(progress * 2);
+  }
+  return 1 - d3.easeExpIn((progress - 0.5) * 2);
+}
+
+function renderVehicles() {
+  vehiclesGroup.selectAll(".vehicle")
+    .data(activeMovements(), d => d.movement_id)
+    .join(enter => {
+      const root = enter.append("g").classed("vehicle", true);
+      root.append("circle")
+        .attr("r", VEHICLE_RADIUS - 1)
+        .style("stroke", "black")
+        .style("stroke-width", 1)
+        .style("fill", (d) => colorRange(d.vehicle_id));
+      root.append("text")
+        .classed("vehicle_label", true)
+        .attr("dx", "6px")
+        .style("font-size", "10px")
+        .text((d) => d.vehicle);
+      return root;
+    })
+      .attr("transform", vehiclePosition)
+      .select("text")
+        .style("opacity", labelOpacity);
+}
+
+function renderControls() {
+  playBtn.text(playback.playing ? "Pause" : "Play");
+  seekSlider.property("value", playback.cursor);
+  timeLabel.text(round(playback.cursor) + " / " + round(playback.timeline.end));
+}
+
+function tick(elapsed) {
+  if (playback.playing) {
+    const delta = playback.lastFrame === null ? 0 : (elapsed - playback.lastFrame) / 1000;
+    playback.cursor = Math.min(playback.cursor + delta * playback.speed, playback.timeline.end);
+    if (playback.cursor >= playback.timeline.end) {
+      playback.playing = false;
+    }
+  }
+  playback.lastFrame = elapsed;
+
+  evictFinished();
+  ensureBuffered();
+  renderVehicles();
+  renderControls();
+}
+
+function seek(ts) {
+  playback.generation += 1;
+  playback.cursor = Math.max(playback.timeline.start, Math.min(ts, playback.timeline.end));
+  playback.buffered.clear();
+  playback.fetching = false;
+  // Any movement overlapping the cursor is in this window, including ones already in progress
+  fetchWindow(playback.cursor, playback.cursor + FETCH_WINDOW);
+}
+
+function setTimeline(timeline) {
+  playback.timeline = timeline;
+  seekSlider
+    .attr("min", timeline.start)
+    .attr("max", timeline.end);
+}
+
+playBtn.on("click", () => {
+  if (!playback.playing && playback.cursor >= playback.timeline.end) {
+    seek(playback.timeline.start);
+  }
+  playback.playing = !playback.playing;
+});
+
+speedSelect.on("change", (event) => {
+  playback.speed = +event.target.value;
+});
+
+seekSlider.on("input", (event) => {
+  seek(+event.target.value);
+});
+
 function init() {
   resetBtn.attr('disabled', true);
+  playback.playing = false;
 
   const promises = [
-    fetch('/api/inconsistencies').then(data => data.json()),
+    fetch(apiUrl('/api/inconsistencies')).then(data => data.json()),
     fetch('/api/hubs').then(data => data.json()),
-    fetch('/api/movements').then(data => data.json())
+    fetch(apiUrl('/api/timeline')).then(data => data.json())
   ];
   
   Promise.all(promises)
-    .then(([inconsistencyRes, hubsRes, movRes]) => { 
+    .then(([inconsistencyRes, hubsRes, timelineRes]) => { 
       handleInconsistencyData(inconsistencyRes.data)
       setTransforms(hubsRes.data);
-      handleMovData(movRes.data); 
       handleHubsData(hubsRes.data); 
+      setTimeline(timelineRes.data);
+      seek(timelineRes.data.start);
+      playback.playing = true;
       resetBtn.attr('disabled', null);
     });
 }
 
+d3.timer(tick);
 init();
 resetBtn.on('click', init);
-
-